@@ -1,11 +1,12 @@
 import numpy as np
 from numba import jit
 import cv2
-from poisson import compute_poisson
+from poisson import poisson_stencil, poisson_solve
+from domain_transform import test_domain_transform
 import os
 
 
-@jit(nopython=True)  # Set "nopython" mode for best performance, equivalent to @njit
+@jit(nopython=True, cache=True)  # Set "nopython" mode for best performance, equivalent to @njit
 def euclidean_distance(p1, p2):
     """
     Compute the euclidean distance between two points
@@ -13,7 +14,7 @@ def euclidean_distance(p1, p2):
     return ((p1[0]-p2[0])**2 + (p1[1]-p2[1])**2 + (p1[2]-p2[2])**2)**0.5
 
 
-@jit(nopython=True)  # Set "nopython" mode for best performance, equivalent to @njit
+@jit(nopython=True, cache=True)  # Set "nopython" mode for best performance, equivalent to @njit
 def get_omega(img, beta, curr_pixel, neighbour_pixel):
     """
     Estimate the omega value for a given pixel and its neighbour
@@ -26,10 +27,49 @@ def get_omega(img, beta, curr_pixel, neighbour_pixel):
     return omega
 
 
-@jit(nopython=True)  # Set "nopython" mode for best performance, equivalent to @njit
-def test_diffusion(rgb_img, scribbles, mask, ignore_mask, beta, iterations):
+@jit(nopython=True, cache=True)
+def omega_field(rgb_img, beta):
+    """
+    Precompute the omega weights of every pixel towards its top, bottom, left and
+    right neighbours, out of bounds neighbours get a weight of 255.
+    Stored as float32, 16 bytes per pixel
+    """
+    h, w = rgb_img.shape[:2]
+    omega = np.full((h, w, 4), 255.0, dtype=np.float32)
+
+    for y in range(0, h):
+        for x in range(0, w):
+            curr_pixel = (y, x)
+            if y > 0:
+                omega[y, x, 0] = get_omega(rgb_img, beta, curr_pixel, (y-1, x))
+            if y < h-1:
+                omega[y, x, 1] = get_omega(rgb_img, beta, curr_pixel, (y+1, x))
+            if x > 0:
+                omega[y, x, 2] = get_omega(rgb_img, beta, curr_pixel, (y, x-1))
+            if x < w-1:
+                omega[y, x, 3] = get_omega(rgb_img, beta, curr_pixel, (y, x+1))
+
+    return omega
+
+
+# Conjugate gradient iterations allowed per solve of the ignored regions, during the
+# diffusion and once it is done
+POISSON_STEP_ITERATIONS = 200
+POISSON_STEP_TOLERANCE = 0.05
+POISSON_FINAL_ITERATIONS = 2000
+
+
+# nogil lets several diffusions share the compute thread pool of the asgi server, cache
+# keeps the compiled solver on disk so new sequence workers do not compile it again
+@jit(nopython=True, nogil=True, cache=True)
+def test_diffusion(rgb_img, scribbles, mask, ignore_mask, beta, iterations, poisson_interval,
+                   init_depth=None, omega=None):
     """
     Solve Poisson's equation using the Jacobi method.
+    Ignored regions are solved directly every poisson_interval iterations and once at
+    the end, with the depth around them as boundary condition. init_depth warm
+    starts the solve and omega reuses weights from omega_field, both are optional,
+    without omega the weights are recomputed every iteration.
     """
     # Ensure inputs are not None and have correct shape
     if scribbles is None:
@@ -40,7 +80,13 @@ def test_diffusion(rgb_img, scribbles, mask, ignore_mask, beta, iterations):
         ignore_mask = np.zeros_like(rgb_img[:,:,0])
         
     h, w = scribbles.shape
-    depth_map = np.ones((h, w))*255
+    if init_depth is None:
+        depth_map = np.ones((h, w))*255
+    else:
+        depth_map = init_depth.astype(np.float64)
+
+    # ignored regions are updated separately, over a precomputed stencil
+    stencil = poisson_stencil(ignore_mask, mask)
 
     for iteration in range(iterations):
         if iteration % 100 == 0:
@@ -53,64 +99,80 @@ def test_diffusion(rgb_img, scribbles, mask, ignore_mask, beta, iterations):
 
         for y in range(0, h):
             for x in range(0, w):
-                curr_pixel = (y, x)
                 # if annotated, then the value of depth is the same as the scribbles
                 if mask[y, x] == 255:
                     new_depth_map[y, x] = scribbles[y, x]
                     continue
 
                 if ignore_mask[y, x] == 255:
-                    # ignored regions will use poisson equation
-                    new_depth_map[y, x] = compute_poisson(
-                        new_depth_map, curr_pixel)
                     continue
 
                 # get neighbouring values, consider out of bounds as white
-                if y > 0:
-                    top = depth_map[y-1, x]
-                    w_top = get_omega(rgb_img, beta, curr_pixel, (y-1, x))
-                else:
-                    top = 255
-                    w_top = 255
-
-                if y < h-1:
-                    bottom = depth_map[y+1, x]
-                    w_bottom = get_omega(
-                        rgb_img, beta, curr_pixel, (y+1, x))
-                else:
-                    bottom = 255
-                    w_bottom = 255
-
-                if x > 0:
-                    left = depth_map[y, x-1]
-                    w_left = get_omega(rgb_img, beta, curr_pixel, (y, x-1))
-                else:
-                    left = 255
-                    w_left = 255
-
-                if x < w-1:
-                    right = depth_map[y, x+1]
-                    w_right = get_omega(rgb_img, beta, curr_pixel, (y, x+1))
+                top = depth_map[y-1, x] if y > 0 else 255
+                bottom = depth_map[y+1, x] if y < h-1 else 255
+                left = depth_map[y, x-1] if x > 0 else 255
+                right = depth_map[y, x+1] if x < w-1 else 255
+                if omega is None:
+                    # omega values of the neighbours, out of bounds weigh 255
+                    curr_pixel = (y, x)
+                    w_top = get_omega(rgb_img, beta, curr_pixel, (y-1, x)) if y > 0 else 255
+                    w_bottom = get_omega(rgb_img, beta, curr_pixel, (y+1, x)) if y < h-1 else 255
+                    w_left = get_omega(rgb_img, beta, curr_pixel, (y, x-1)) if x > 0 else 255
+                    w_right = get_omega(rgb_img, beta, curr_pixel, (y, x+1)) if x < w-1 else 255
                 else:
-                    right = 255
-                    w_right = 255
+                    w_top, w_bottom, w_left, w_right = \
+                        omega[y, x, 0], omega[y, x, 1], omega[y, x, 2], omega[y, x, 3]
 
                 # update depth value with omega weights and depth values
                 new_depth_map[y, x] = (w_top*top + w_bottom*bottom + w_left *
                                        left + w_right*right)/(w_top+w_bottom+w_left+w_right)
+
+        # ignored regions will use poisson equation, solved from the current boundary.
+        # Each solve starts from the previous one, so a large region that needs more
+        # than POISSON_STEP_ITERATIONS keeps converging over the next solves
+        if (iteration + 1) % poisson_interval == 0:
+            poisson_solve(new_depth_map, stencil, POISSON_STEP_ITERATIONS, POISSON_STEP_TOLERANCE)
+
         depth_map = new_depth_map
 
+    # the final boundary is known, finish the ignored regions on it
+    poisson_solve(depth_map, stencil, POISSON_FINAL_ITERATIONS)
+
     # Return both 100% progress and the final result
     yield (100, depth_map)
 
 
-def test_anisotropic(rgb_img, scribbles, mask, ignore_mask, beta=0.1, iterations=3000, stream_progress=False):
+# Propagation engines accepted by test_anisotropic
+PROPAGATION_METHODS = ('anisotropic', 'domain_transform')
+
+
+# Above this many pixels the single image solve recomputes the weights every iteration
+# rather than holding a 16 bytes per pixel omega field (64 MB at the limit)
+OMEGA_FIELD_MAX_PIXELS = 4_000_000
+
+
+def test_anisotropic(rgb_img, scribbles, mask, ignore_mask, beta=0.1, iterations=3000, stream_progress=False,
+                     method='anisotropic', sigma_r=0.1, passes=3, poisson_interval=25):
     """
     Process the anisotropic diffusion directly with image data
+
+    method selects the propagation engine: 'anisotropic' runs the Jacobi diffusion for
+    the given iterations, 'domain_transform' runs a few recursive filter passes
+    (sigma_r, passes) instead
     """
     try:
+        if method == 'anisotropic':
+            h, w = rgb_img.shape[:2]
+            omega = omega_field(rgb_img, beta) if h * w <= OMEGA_FIELD_MAX_PIXELS else None
+            engine = test_diffusion(rgb_img, scribbles, mask, ignore_mask, beta, iterations, poisson_interval,
+                                    None, omega)
+        elif method == 'domain_transform':
+            engine = test_domain_transform(rgb_img, scribbles, mask, ignore_mask, sigma_r=sigma_r, passes=passes)
+        else:
+            raise ValueError(f"Unknown propagation method: {method}")
+
         # Process the image
-        for progress, result in test_diffusion(rgb_img, scribbles, mask, ignore_mask, beta, iterations):
+        for progress, result in engine:
             if stream_progress:
                 yield progress, result
             
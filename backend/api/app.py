@@ -5,14 +5,18 @@ import numpy as np
 import os
 import json
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import BadRequest
 from scribble_process import create_masks_and_annotations
 from focus import test_focus
-from anisotropic import test_anisotropic
+from anisotropic import test_anisotropic, PROPAGATION_METHODS
+from sequence import test_sequence
+from shared import SharedArrayRegistry
 from config import Config
 import base64
 
 app = Flask(__name__)
 config = Config()
+app.config['MAX_CONTENT_LENGTH'] = config.MAX_CONTENT_LENGTH
 
 # Use only the CORS middleware with simpler configuration
 CORS(app, 
@@ -30,6 +34,12 @@ def add_security_headers(response):
     response.headers['Strict-Transport-Security'] = 'max-age=31536000; includeSubDomains'
     return response
 
+# Reject oversized uploads before any of the body is read
+@app.before_request
+def check_content_length():
+    if request.content_length is not None and request.content_length > config.MAX_CONTENT_LENGTH:
+        return jsonify({'status': 'error', 'message': 'Request body too large'}), 413
+
 # Directory setup
 BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 UPLOAD_FOLDER = os.path.join(BACKEND_DIR, 'uploads')
@@ -45,7 +55,7 @@ def get_image_url(filename, folder='outputs'):
     return f"{config.BACKEND_URL}/{folder}/{filename}"
 
 # Add these helper functions before the routes
-def decode_base64_image(base64_string):
+def decode_base64_image(base64_string, grayscale=False):
     """Convert base64 string to cv2 image"""
     try:
         # Remove the data URL prefix if present
@@ -60,7 +70,7 @@ def decode_base64_image(base64_string):
         # Decode base64 string
         img_data = base64.b64decode(base64_string)
         nparr = np.frombuffer(img_data, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        img = cv2.imdecode(nparr, cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_COLOR)
         
         if img is None:
             print("Failed to decode image: cv2.imdecode returned None")
@@ -73,6 +83,88 @@ def decode_base64_image(base64_string):
         print(f"First 100 chars of base64 string: {base64_string[:100]}")
         return None
 
+def read_upload(file):
+    """Read an uploaded file straight into a NumPy byte buffer"""
+    stream = file.stream
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+
+    buffer = np.empty(size, dtype=np.uint8)
+    view = memoryview(buffer)
+    read = 0
+    while read < size:
+        n = stream.readinto(view[read:])
+        if not n:
+            break
+        read += n
+    return buffer[:read]
+
+def decode_rle_mask(data):
+    """
+    Convert a run-length encoded mask to a cv2 image. The format is JSON
+    {"size": [h, w], "counts": [...]}, runs are row-major and alternate
+    between 0 and 255, starting with 0
+    """
+    rle = json.loads(data.tobytes())
+    h, w = (int(n) for n in rle['size'])
+    # check the size before anything is allocated for it
+    if h <= 0 or w <= 0:
+        raise ValueError(f"RLE size must be positive, got {h}x{w}")
+    if h * w > config.MAX_IMAGE_PIXELS:
+        raise ValueError(f"RLE mask of {h}x{w} is larger than {config.MAX_IMAGE_PIXELS} pixels")
+    counts = np.asarray(rle['counts'], dtype=np.int64)
+    if counts.ndim != 1 or (counts < 0).any():
+        raise ValueError("RLE counts must be a list of non-negative run lengths")
+    if counts.sum() != h * w:
+        raise ValueError(f"RLE counts cover {counts.sum()} pixels, expected {h * w}")
+
+    values = np.zeros(len(counts), dtype=np.uint8)
+    values[1::2] = 255
+    return np.repeat(values, counts).reshape(h, w)
+
+def decode_upload(file, grayscale=False):
+    """Convert an uploaded file (PNG/JPEG, 1-bit PNG or RLE mask) to cv2 image"""
+    try:
+        data = read_upload(file)
+        if file.mimetype == 'application/x-rle' or (file.filename or '').endswith('.rle'):
+            return decode_rle_mask(data)
+
+        img = cv2.imdecode(data, cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_COLOR)
+        if img is None:
+            print("Failed to decode upload: cv2.imdecode returned None")
+            print("Upload data length:", len(data))
+        return img
+    except Exception as e:
+        print(f"Error decoding upload {file.name}: {str(e)}")
+        return None
+
+def read_request_images(req):
+    """
+    Get the fields and an image decoder for a request, images are either
+    multipart file parts or base64 strings in a JSON body. The decoder raises
+    BadRequest for a missing part and returns None for one it cannot decode
+    """
+    if req.mimetype == 'multipart/form-data':
+        def decode(name, grayscale=False):
+            if name not in req.files:
+                raise BadRequest(f"Missing file part '{name}'")
+            return decode_upload(req.files[name], grayscale)
+        return req.form, decode
+
+    if req.mimetype != 'application/json':
+        raise BadRequest(f"Unsupported Content-Type '{req.mimetype}', "
+                         "send multipart/form-data or application/json")
+
+    data = req.get_json(silent=True)
+    if not isinstance(data, dict):
+        raise BadRequest("Request body is not a JSON object")
+    def decode(name, grayscale=False):
+        if name not in data:
+            raise BadRequest(f"Missing field '{name}'")
+        return decode_base64_image(data[name], grayscale)
+    return data, decode
+
 def encode_image_to_base64(image):
     """Convert cv2 image to base64 string"""
     try:
@@ -178,172 +270,347 @@ def generate_progress(image_name, beta, iterations):
     except Exception as e:
         yield f"data: {json.dumps({'status': 'error', 'message': str(e)})}\n\n"
 
-@app.route('/api/process-anisotropic', methods=['POST', 'OPTIONS'])
-def process_anisotropic():
-    if request.method == 'OPTIONS':
-        return '', 204
+def check_mask_shapes(shape, masks, owner="the image"):
+    """
+    Raise BadRequest unless every mask has the height and width of the image, the
+    solvers index masks with image coordinates and do not bounds check
+    """
+    h, w = shape[:2]
+    wrong = [f"{name} is {mask.shape[1]}x{mask.shape[0]}" for name, mask in masks.items()
+             if mask is not None and tuple(mask.shape[:2]) != (h, w)]
+    if wrong:
+        raise BadRequest(f"Masks of {owner} must be {w}x{h}: {', '.join(wrong)}")
+
+def parse_anisotropic_request(req):
+    """Decode the images and options of a process-anisotropic request"""
+    data, decode = read_request_images(req)
+    options = {
+        'beta': float(data.get('beta', 0.1)),
+        'iterations': int(data.get('iterations', 3000)),
+        'method': data.get('method', 'anisotropic'),
+        'sigma_r': float(data.get('sigmaR', 0.1)),
+        'passes': int(data.get('passes', 3))
+    }
+    if options['method'] not in PROPAGATION_METHODS:
+        raise BadRequest(f"Unknown propagation method '{options['method']}', "
+                         f"use one of: {', '.join(PROPAGATION_METHODS)}")
+    
+    # Decode the images, masks are read as single channel
+    image = decode('imageData')
+    annotations = decode('annotations', grayscale=True)
+    mask = decode('mask', grayscale=True)
+    ignore_mask = decode('ignoreMask', grayscale=True)
+    
+    # Add detailed error messages for each image
+    failed_images = []
+    if image is None:
+        failed_images.append("original image")
+    if annotations is None:
+        failed_images.append("annotations")
+    if mask is None:
+        failed_images.append("mask")
+    if ignore_mask is None:
+        failed_images.append("ignore mask")
         
+    if failed_images:
+        error_msg = f"Failed to decode the following images: {', '.join(failed_images)}"
+        raise BadRequest(error_msg)
+    check_mask_shapes(image.shape, {'annotations': annotations, 'mask': mask, 'ignoreMask': ignore_mask})
+
+    return image, annotations, mask, ignore_mask, options
+
+def generate_anisotropic_events(image, annotations, mask, ignore_mask, options):
+    """Run the diffusion and yield its progress and result as SSE messages"""
     try:
-        data = request.json
-        image_data = data['imageData']
-        annotations_data = data['annotations']
-        mask_data = data['mask']
-        ignore_mask_data = data['ignoreMask']
-        beta = data.get('beta', 0.1)
-        iterations = data.get('iterations', 3000)
+        last_progress = 0
+        result = None
         
-        # Convert base64 to cv2 images and ensure they're not None
-        image = decode_base64_image(image_data)
-        annotations = decode_base64_image(annotations_data)
-        mask = decode_base64_image(mask_data)
-        ignore_mask = decode_base64_image(ignore_mask_data)
+        # Get the generator
+        anisotropic_gen = test_anisotropic(
+            image, 
+            annotations,
+            mask,
+            ignore_mask,
+            options['beta'], 
+            options['iterations'], 
+            stream_progress=True,
+            method=options['method'],
+            sigma_r=options['sigma_r'],
+            passes=options['passes']
+        )
         
-        # Add detailed error messages for each image
-        failed_images = []
-        if image is None:
-            failed_images.append("original image")
-        if annotations is None:
-            failed_images.append("annotations")
-        if mask is None:
-            failed_images.append("mask")
-        if ignore_mask is None:
-            failed_images.append("ignore mask")
-            
-        if failed_images:
-            error_msg = f"Failed to decode the following images: {', '.join(failed_images)}"
-            raise ValueError(error_msg)
-
-        # Convert annotations and masks to grayscale if they aren't already
-        if len(annotations.shape) > 2:
-            annotations = cv2.cvtColor(annotations, cv2.COLOR_BGR2GRAY)
-        if len(mask.shape) > 2:
-            mask = cv2.cvtColor(mask, cv2.COLOR_BGR2GRAY)
-        if len(ignore_mask.shape) > 2:
-            ignore_mask = cv2.cvtColor(ignore_mask, cv2.COLOR_BGR2GRAY)
-
-        def generate():
+        # Stream progress updates
+        for progress, current_result in anisotropic_gen:
             try:
-                last_progress = 0
-                result = None
+                # Only send progress update if it's changed significantly
+                if progress - last_progress >= 1 or progress >= 100:
+                    last_progress = progress
+                    progress_data = json.dumps({'progress': progress})
+                    yield f"data: {progress_data}\n\n"
                 
-                # Get the generator
-                anisotropic_gen = test_anisotropic(
-                    image, 
-                    annotations,
-                    mask,
-                    ignore_mask,
-                    beta, 
-                    iterations, 
-                    stream_progress=True
-                )
-                
-                # Stream progress updates
-                for progress, current_result in anisotropic_gen:
-                    try:
-                        # Only send progress update if it's changed significantly
-                        if progress - last_progress >= 1 or progress >= 100:
-                            last_progress = progress
-                            progress_data = json.dumps({'progress': progress})
-                            yield f"data: {progress_data}\n\n"
-                        
-                        # Store the result
-                        if current_result is not None:
-                            result = current_result
-                    except Exception as e:
-                        print(f"Error in progress update: {str(e)}")
-                        continue
-                
-                # Always send final result
-                if result is not None:
-                    try:
-                        result_base64 = encode_image_to_base64(result)
-                        final_result = {
-                            'status': 'success',
-                            'images': {
-                                'anisotropic': {
-                                    'src': f'data:image/png;base64,{result_base64}',
-                                    'title': 'Anisotropic Diffusion'
-                                }
-                            }
+                # Store the result
+                if current_result is not None:
+                    result = current_result
+            except Exception as e:
+                print(f"Error in progress update: {str(e)}")
+                continue
+        
+        # Always send final result
+        if result is not None:
+            try:
+                result_base64 = encode_image_to_base64(result)
+                final_result = {
+                    'status': 'success',
+                    'images': {
+                        'anisotropic': {
+                            'src': f'data:image/png;base64,{result_base64}',
+                            'title': 'Anisotropic Diffusion'
                         }
-                        yield f"data: {json.dumps(final_result)}\n\n"
-                    except Exception as e:
-                        print(f"Error encoding final result: {str(e)}")
-                        raise
-                else:
-                    raise ValueError("No result generated")
-                        
+                    }
+                }
+                yield f"data: {json.dumps(final_result)}\n\n"
             except Exception as e:
-                print(f"Error in generate: {str(e)}")
-                error_data = json.dumps({'status': 'error', 'message': str(e)})
-                yield f"data: {error_data}\n\n"
+                print(f"Error encoding final result: {str(e)}")
+                raise
+        else:
+            raise ValueError("No result generated")
+                
+    except Exception as e:
+        print(f"Error in generate: {str(e)}")
+        error_data = json.dumps({'status': 'error', 'message': str(e)})
+        yield f"data: {error_data}\n\n"
+
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'Connection': 'keep-alive',
+    'X-Accel-Buffering': 'no',
+    'Content-Type': 'text/event-stream'
+}
+
+@app.route('/api/process-anisotropic', methods=['POST', 'OPTIONS'])
+def process_anisotropic():
+    if request.method == 'OPTIONS':
+        return '', 204
         
-        response = Response(generate(), mimetype='text/event-stream')
-        response.headers.update({
-            'Cache-Control': 'no-cache',
-            'Connection': 'keep-alive',
-            'X-Accel-Buffering': 'no',
-            'Content-Type': 'text/event-stream'
-        })
+    try:
+        inputs = parse_anisotropic_request(request)
+
+        response = Response(generate_anisotropic_events(*inputs), mimetype='text/event-stream')
+        response.headers.update(SSE_HEADERS)
         return response
         
+    except BadRequest as e:
+        return jsonify({'status': 'error', 'message': e.description}), 400
     except Exception as e:
         print(f"Error in process_anisotropic: {str(e)}")
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+SEQUENCE_MASKS = ('annotations', 'mask', 'ignoreMask')
+
+def parse_sequence_request(req, registry):
+    """
+    Decode the frames, keyframe scribbles and options of a process-sequence request.
+    JSON bodies send 'frames' as a list of base64 images and 'keyframes' as a list of
+    {index, annotations, mask, ignoreMask}. Multipart bodies send repeated 'frames'
+    parts, 'keyframes' as a JSON list of indices and 'annotations.<index>',
+    'mask.<index>' and 'ignoreMask.<index>' parts.
+    Images are moved to shared memory in registry as soon as they are decoded
+    """
+    def share(img):
+        return registry.share(img) if img is not None else None
+
+    if req.mimetype == 'multipart/form-data':
+        data = req.form
+        if 'frames' not in req.files:
+            raise BadRequest("Missing file part 'frames'")
+        if 'keyframes' not in data:
+            raise BadRequest("Missing field 'keyframes'")
+        try:
+            indices = [int(index) for index in json.loads(data['keyframes'])]
+        except (ValueError, TypeError) as e:
+            raise BadRequest(f"Field 'keyframes' is not a JSON list of frame indices: {str(e)}")
+        frames = [share(decode_upload(file)) for file in req.files.getlist('frames')]
+        keyframes = {}
+        for index in indices:
+            keyframes[index] = tuple(
+                share(decode_upload(req.files[f'{name}.{index}'], grayscale=True))
+                if f'{name}.{index}' in req.files else None
+                for name in SEQUENCE_MASKS)
+    elif req.mimetype == 'application/json':
+        data = req.get_json(silent=True)
+        if not isinstance(data, dict):
+            raise BadRequest("Request body is not a JSON object")
+        for name in ('frames', 'keyframes'):
+            if not isinstance(data.get(name), list):
+                raise BadRequest(f"Field '{name}' must be a list")
+        if not all(isinstance(keyframe, dict) and 'index' in keyframe for keyframe in data['keyframes']):
+            raise BadRequest("Every keyframe needs an 'index'")
+        frames = [share(decode_base64_image(frame)) for frame in data['frames']]
+        keyframes = {}
+        for keyframe in data['keyframes']:
+            keyframes[int(keyframe['index'])] = tuple(
+                share(decode_base64_image(keyframe[name], grayscale=True)) if name in keyframe else None
+                for name in SEQUENCE_MASKS)
+    else:
+        raise BadRequest(f"Unsupported Content-Type '{req.mimetype}', "
+                         "send multipart/form-data or application/json")
+
+    options = {
+        'beta': float(data.get('beta', 0.1)),
+        'iterations': int(data.get('iterations', 3000)),
+        'warm_iterations': int(data.get('warmIterations', 500)),
+        'similarity': float(data.get('similarity', 2.0))
+    }
+
+    if not frames:
+        raise BadRequest("At least one frame is required")
+    failed_frames = [str(i) for i, frame in enumerate(frames) if frame is None]
+    if failed_frames:
+        raise BadRequest(f"Failed to decode the following frames: {', '.join(failed_frames)}")
+    if len({frame.shape for frame in frames}) > 1:
+        raise BadRequest("All frames must have the same size")
+
+    if not keyframes:
+        raise BadRequest("At least one keyframe with scribbles is required")
+    out_of_range = [str(i) for i in keyframes if i < 0 or i >= len(frames)]
+    if out_of_range:
+        raise BadRequest(f"Keyframe index out of range: {', '.join(out_of_range)}")
+    failed_keyframes = [str(i) for i, images in keyframes.items() if any(img is None for img in images)]
+    if failed_keyframes:
+        raise BadRequest(f"Failed to decode the scribbles of keyframes: {', '.join(failed_keyframes)}")
+    for index, images in keyframes.items():
+        check_mask_shapes(frames[0].shape, dict(zip(SEQUENCE_MASKS, images)), f"keyframe {index}")
+
+    return frames, keyframes, options
+
+def sse_message(data):
+    """Format data as one SSE message"""
+    return f"data: {json.dumps(data)}\n\n"
+
+def sequence_result_message(depth_maps):
+    """The last SSE message of a sequence, with every depth map as a PNG"""
+    return sse_message({
+        'status': 'success',
+        'images': {
+            'sequence': [
+                {
+                    'src': f'data:image/png;base64,{encode_image_to_base64(depth_map)}',
+                    'title': f'Frame {i}'
+                }
+                for i, depth_map in enumerate(depth_maps)
+            ]
+        }
+    })
+
+def generate_sequence_events(frames, keyframes, options, registry):
+    """Run the sequence propagation and yield its progress and result as SSE messages"""
+    try:
+        result = None
+        sequence_gen = test_sequence(
+            frames,
+            keyframes,
+            workers=config.COMPUTE_WORKERS,
+            stream_progress=True,
+            registry=registry,
+            **options
+        )
+
+        for progress, current_result in sequence_gen:
+            yield sse_message({'progress': progress})
+            if current_result is not None:
+                result = current_result
+
+        yield sequence_result_message(result)
+
+    except Exception as e:
+        print(f"Error in generate_sequence_events: {str(e)}")
+        yield sse_message({'status': 'error', 'message': str(e)})
+
+@app.route('/api/process-sequence', methods=['POST', 'OPTIONS'])
+def process_sequence():
+    if request.method == 'OPTIONS':
+        return '', 204
+
+    registry = SharedArrayRegistry()
+    try:
+        inputs = parse_sequence_request(request, registry)
+
+        response = Response(generate_sequence_events(*inputs, registry), mimetype='text/event-stream')
+        response.headers.update(SSE_HEADERS)
+        # free the shared memory once the stream is done, even if the client left early
+        response.call_on_close(registry.close)
+        return response
+
+    except BadRequest as e:
+        registry.close()
+        return jsonify({'status': 'error', 'message': e.description}), 400
+    except Exception as e:
+        print(f"Error in process_sequence: {str(e)}")
+        registry.close()
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+def run_focus_request(req):
+    """Decode a process-focus request, apply the focus effect and build the response"""
+    data, decode = read_request_images(req)
+    focus_point = data.get('focusPoint')
+    if focus_point is None:
+        raise BadRequest("Missing field 'focusPoint'")
+    if isinstance(focus_point, str):
+        # multipart requests send the point as a JSON field
+        focus_point = json.loads(focus_point)
+    
+    # Original image and anisotropic result image
+    rgb_img = decode('imageData')
+    depth_map = decode('anisotropicResult')
+    
+    if rgb_img is None or depth_map is None:
+        raise BadRequest("Could not decode image data")
+
+    # Process focus
+    result_images = test_focus(
+        rgb_img=rgb_img,
+        depth_map=depth_map,
+        focus_point=focus_point,
+        depth_range=float(data.get('depthRange', 0.1)),
+        kernel_size_gaus=int(data.get('kernelSizeGaus', 5)),
+        kernel_size_bf=int(data.get('kernelSizeBf', 5)),
+        sigma_color=float(data.get('sigmaColor', 200)),
+        sigma_space=float(data.get('sigmaSpace', 200)),
+        gaus_sigma=float(data.get('gausSigma', 60))
+    )
+    
+    # Convert results back to base64 and return to frontend
+    return {
+        'status': 'success',
+        'images': {
+            'depthNorm': {
+                'src': f'data:image/png;base64,{encode_image_to_base64(result_images["depth_norm"])}',
+                'title': 'Depth Normalized'
+            },
+            'mask': {
+                'src': f'data:image/png;base64,{encode_image_to_base64(result_images["mask"])}',
+                'title': 'Focus Mask'
+            },
+            'bf': {
+                'src': f'data:image/png;base64,{encode_image_to_base64(result_images["bf"])}',
+                'title': 'Bilateral Filter'
+            },
+            'blended': {
+                'src': f'data:image/png;base64,{encode_image_to_base64(result_images["blended"])}',
+                'title': 'Final Result'
+            }
+        }
+    }
+
 @app.route('/api/process-focus', methods=['POST', 'OPTIONS'])
 def process_focus():
     if request.method == 'OPTIONS':
         return '', 204
         
     try:
-        data = request.json
-        image_data = data['imageData']  # Original image
-        anisotropic_data = data['anisotropicResult']  # Anisotropic result image
-        focus_point = data['focusPoint']
-        
-        # Convert base64 to cv2 images
-        rgb_img = decode_base64_image(image_data)
-        depth_map = decode_base64_image(anisotropic_data)
-        
-        if rgb_img is None or depth_map is None:
-            raise ValueError("Could not decode image data")
-
-        # Process focus
-        result_images = test_focus(
-            rgb_img=rgb_img,
-            depth_map=depth_map,
-            focus_point=focus_point,
-            depth_range=float(data.get('depthRange', 0.1)),
-            kernel_size_gaus=int(data.get('kernelSizeGaus', 5)),
-            kernel_size_bf=int(data.get('kernelSizeBf', 5)),
-            sigma_color=float(data.get('sigmaColor', 200)),
-            sigma_space=float(data.get('sigmaSpace', 200)),
-            gaus_sigma=float(data.get('gausSigma', 60))
-        )
-        
-        # Convert results back to base64 and return to frontend
-        return jsonify({
-            'status': 'success',
-            'images': {
-                'depthNorm': {
-                    'src': f'data:image/png;base64,{encode_image_to_base64(result_images["depth_norm"])}',
-                    'title': 'Depth Normalized'
-                },
-                'mask': {
-                    'src': f'data:image/png;base64,{encode_image_to_base64(result_images["mask"])}',
-                    'title': 'Focus Mask'
-                },
-                'bf': {
-                    'src': f'data:image/png;base64,{encode_image_to_base64(result_images["bf"])}',
-                    'title': 'Bilateral Filter'
-                },
-                'blended': {
-                    'src': f'data:image/png;base64,{encode_image_to_base64(result_images["blended"])}',
-                    'title': 'Final Result'
-                }
-            }
-        })
+        return jsonify(run_focus_request(request))
+    except BadRequest as e:
+        return jsonify({'status': 'error', 'message': e.description}), 400
     except Exception as e:
         print(f"Error in process_focus: {str(e)}")
         return jsonify({'status': 'error', 'message': str(e)}), 500
@@ -361,7 +628,12 @@ def add_security_headers(response):
     return response
 
 if __name__ == '__main__':
-    if config.ENV == 'production':
+    if config.SERVER_MODE == 'asgi':
+        # long-lived SSE streams only cost a coroutine, CPU work runs in a fixed pool
+        import uvicorn
+        host = '0.0.0.0' if config.ENV == 'production' else '127.0.0.1'
+        uvicorn.run('api.asgi:app', host=host, port=5000)
+    elif config.ENV == 'production':
         # good for concurrency
         from waitress import serve
         serve(app, host='0.0.0.0', port=5000)
@@ -0,0 +1,371 @@
+import asyncio
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+from werkzeug.exceptions import BadRequest
+from werkzeug.wrappers import Request
+from api.app import (app as flask_app, config, parse_anisotropic_request, generate_anisotropic_events,
+                     run_focus_request, parse_sequence_request, sequence_result_message, sse_message,
+                     SSE_HEADERS)
+from sequence import SequenceSolve, shutdown_pool
+from shared import SharedArrayRegistry
+
+# CPU work (decoding, diffusion, encoding) runs here, the event loop only holds connections
+compute_pool = ThreadPoolExecutor(max_workers=config.COMPUTE_WORKERS)
+# Plain Flask routes run here, see Config.REQUEST_WORKERS
+request_pool = ThreadPoolExecutor(max_workers=config.REQUEST_WORKERS)
+
+SECURITY_HEADERS = {
+    'X-Content-Type-Options': 'nosniff',
+    'X-Frame-Options': 'DENY',
+    'X-XSS-Protection': '1; mode=block',
+    'Strict-Transport-Security': 'max-age=31536000; includeSubDomains'
+}
+
+_DONE = object()
+
+
+def cors_headers(scope):
+    """Mirror the flask-cors configuration for responses sent outside Flask"""
+    origin = dict(scope['headers']).get(b'origin', b'').decode('latin-1')
+    allowed = config.FRONTEND_URL
+    if isinstance(allowed, str):
+        allowed = [allowed]
+    if origin and origin in allowed:
+        return {
+            'Access-Control-Allow-Origin': origin,
+            'Access-Control-Allow-Credentials': 'true',
+            'Vary': 'Origin'
+        }
+    return {}
+
+
+# Bodies larger than this are spooled to disk while they are received
+SPOOL_SIZE = 1024 * 1024
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+async def read_body(receive):
+    """Spool the request body from the ASGI receive channel, up to MAX_CONTENT_LENGTH"""
+    body = SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    length = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            body.close()
+            return None
+        chunk = message.get('body', b'')
+        length += len(chunk)
+        if length > config.MAX_CONTENT_LENGTH:
+            body.close()
+            raise BodyTooLarge()
+        body.write(chunk)
+        if not message.get('more_body', False):
+            body.seek(0)
+            return body
+
+
+def build_environ(scope, body):
+    """WSGI environ for an ASGI scope whose body is already spooled"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        # the body is fully spooled, so it can be read to the end even without a Content-Length
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[name] = value
+        else:
+            key = f'HTTP_{name}'
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+def build_request(scope, body):
+    """Wrap the ASGI scope and spooled body in a werkzeug request"""
+    return Request(build_environ(scope, body))
+
+
+async def start_response(send, scope, status, headers):
+    headers = {**headers, **SECURITY_HEADERS, **cors_headers(scope)}
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers.items()]
+    })
+
+
+async def send_json(send, scope, status, data):
+    await start_response(send, scope, status, {'Content-Type': 'application/json'})
+    await send({'type': 'http.response.body', 'body': json.dumps(data).encode('utf-8')})
+
+
+async def send_error(send, scope, status, message):
+    await send_json(send, scope, status, {'status': 'error', 'message': message})
+
+
+async def receive_body(scope, receive, send):
+    """Read the body, answering 413 and returning None when it is over the limit"""
+    content_length = dict(scope['headers']).get(b'content-length')
+    if content_length is not None and int(content_length) > config.MAX_CONTENT_LENGTH:
+        await send_error(send, scope, 413, 'Request body too large')
+        return None
+
+    try:
+        return await read_body(receive)
+    except BodyTooLarge:
+        await send_error(send, scope, 413, 'Request body too large')
+        return None
+
+
+async def finish_in_executor(executor, fn, *args):
+    """
+    Run fn on executor. A thread cannot be interrupted, so when the caller is cancelled
+    this waits for fn to return before raising, and what fn uses can be freed after
+    """
+    future = asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        await asyncio.wait([future])
+        raise
+
+
+async def iterate_in_executor(events, executor):
+    """Async iterator over a generator, advancing it on executor"""
+    try:
+        while True:
+            # each step advances the solver to its next progress update
+            event = await finish_in_executor(executor, next, events, _DONE)
+            if event is _DONE:
+                return
+            yield event
+    finally:
+        # no step is running any more, a generator cannot be closed while it runs
+        events.close()
+
+
+async def watch_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def stream_events(scope, receive, send, events):
+    """Send the messages of an async SSE iterator"""
+    # Stop computing as soon as the client goes away
+    disconnected = asyncio.create_task(watch_disconnect(receive))
+    step = None
+    try:
+        await start_response(send, scope, 200, SSE_HEADERS)
+        while True:
+            step = asyncio.ensure_future(anext(events))
+            await asyncio.wait([step, disconnected], return_when=asyncio.FIRST_COMPLETED)
+            if not step.done():
+                break
+            try:
+                event = step.result()
+            except StopAsyncIteration:
+                await send({'type': 'http.response.body', 'body': b''})
+                break
+            await send({'type': 'http.response.body', 'body': event.encode('utf-8'), 'more_body': True})
+    except OSError as e:
+        print(f"Client disconnected from {scope['path']}: {str(e)}")
+    finally:
+        disconnected.cancel()
+        # let the iterator finish its current step, so it is done with everything the
+        # caller frees once this returns
+        if step is not None and not step.done():
+            step.cancel()
+            await asyncio.wait([step])
+        await events.aclose()
+
+
+async def process_anisotropic(scope, receive, send):
+    """Async version of the process-anisotropic SSE endpoint"""
+    loop = asyncio.get_running_loop()
+
+    body = await receive_body(scope, receive, send)
+    if body is None:
+        return
+
+    try:
+        with body:
+            inputs = await loop.run_in_executor(
+                compute_pool, lambda: parse_anisotropic_request(build_request(scope, body)))
+    except BadRequest as e:
+        await send_error(send, scope, 400, e.description)
+        return
+    except Exception as e:
+        print(f"Error in process_anisotropic: {str(e)}")
+        await send_error(send, scope, 500, str(e))
+        return
+
+    events = iterate_in_executor(generate_anisotropic_events(*inputs), compute_pool)
+    await stream_events(scope, receive, send, events)
+
+
+async def process_focus(scope, receive, send):
+    """Async version of the process-focus endpoint"""
+    loop = asyncio.get_running_loop()
+
+    body = await receive_body(scope, receive, send)
+    if body is None:
+        return
+
+    try:
+        with body:
+            result = await loop.run_in_executor(
+                compute_pool, lambda: run_focus_request(build_request(scope, body)))
+    except BadRequest as e:
+        await send_error(send, scope, 400, e.description)
+        return
+    except Exception as e:
+        print(f"Error in process_focus: {str(e)}")
+        await send_error(send, scope, 500, str(e))
+        return
+
+    await send_json(send, scope, 200, result)
+
+
+async def sequence_events(frames, keyframes, options, registry):
+    """
+    Async version of generate_sequence_events. The frames are solved in worker
+    processes and their futures awaited here on the event loop, only the bookkeeping
+    between frames and the final encoding take a compute_pool thread
+    """
+    solve = None
+    # asyncio wrapper of every frame being solved, with its future
+    frames_running = {}
+    try:
+        solve = await finish_in_executor(compute_pool, lambda: SequenceSolve(
+            frames, keyframes, registry, workers=config.COMPUTE_WORKERS, **options))
+        await finish_in_executor(compute_pool, solve.start)
+        while solve.futures:
+            submitted = set(frames_running.values())
+            frames_running.update({asyncio.wrap_future(future): future
+                                   for future in solve.futures if future not in submitted})
+            finished, _ = await asyncio.wait(frames_running, return_when=asyncio.FIRST_COMPLETED)
+            for wrapper in finished:
+                # frame_done raises the error of a failed frame, not its wrapper
+                wrapper.exception()
+                future = frames_running.pop(wrapper)
+                progress = await finish_in_executor(compute_pool, solve.frame_done, future)
+                if progress < 100:
+                    yield sse_message({'progress': progress})
+        yield await finish_in_executor(compute_pool, lambda: sequence_result_message(solve.result()))
+    except Exception as e:
+        print(f"Error in process_sequence: {str(e)}")
+        yield sse_message({'status': 'error', 'message': str(e)})
+    finally:
+        if solve is not None:
+            solve.cancel()
+        for wrapper in frames_running:
+            wrapper.cancel()
+
+
+async def process_sequence(scope, receive, send):
+    """Async version of the process-sequence SSE endpoint"""
+    body = await receive_body(scope, receive, send)
+    if body is None:
+        return
+
+    registry = SharedArrayRegistry()
+    try:
+        try:
+            with body:
+                inputs = await finish_in_executor(
+                    compute_pool, lambda: parse_sequence_request(build_request(scope, body), registry))
+        except BadRequest as e:
+            await send_error(send, scope, 400, e.description)
+            return
+        except Exception as e:
+            print(f"Error in process_sequence: {str(e)}")
+            await send_error(send, scope, 500, str(e))
+            return
+
+        await stream_events(scope, receive, send, sequence_events(*inputs, registry))
+    finally:
+        # every step using the registry has returned by now, see finish_in_executor
+        registry.close()
+
+
+async def serve_wsgi(scope, receive, send):
+    """Serve a request with the Flask app, running it on request_pool"""
+    loop = asyncio.get_running_loop()
+
+    body = await receive_body(scope, receive, send)
+    if body is None:
+        return
+
+    response = {}
+
+    def wsgi_start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = headers
+
+    with body:
+        environ = build_environ(scope, body)
+        chunks = await loop.run_in_executor(request_pool, flask_app, environ, wsgi_start_response)
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': response['status'],
+                'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in response['headers']]
+            })
+            chunks_iter = iter(chunks)
+            while True:
+                chunk = await loop.run_in_executor(request_pool, next, chunks_iter, _DONE)
+                if chunk is _DONE:
+                    break
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(chunks, 'close'):
+                await loop.run_in_executor(request_pool, chunks.close)
+
+
+# Routes served natively, everything else (uploads, annotations, preflight...) goes to Flask
+ASYNC_ROUTES = {
+    '/api/process-anisotropic': process_anisotropic,
+    '/api/process-focus': process_focus,
+    '/api/process-sequence': process_sequence
+}
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'http':
+        handler = ASYNC_ROUTES.get(scope['path']) if scope['method'] == 'POST' else None
+        await (handler or serve_wsgi)(scope, receive, send)
+    elif scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                compute_pool.shutdown(wait=False, cancel_futures=True)
+                request_pool.shutdown(wait=False, cancel_futures=True)
+                shutdown_pool()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
@@ -0,0 +1,79 @@
+"""
+Time the anisotropic diffusion with and without a precomputed omega field, on a sample
+image from frontend/public/images with random scribbles
+
+    python benchmark.py --iterations 300 --scale 1.0
+"""
+import argparse
+import os
+import random
+import time
+import cv2
+import numpy as np
+from anisotropic import test_diffusion, omega_field
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+IMAGES_DIR = os.path.join(BACKEND_DIR, '..', 'frontend', 'public', 'images')
+
+
+def random_scribbles(shape, rng):
+    """A few grey strokes as (scribbles, mask)"""
+    h, w = shape
+    scribbles = np.zeros((h, w), dtype=np.uint8)
+    mask = np.zeros((h, w), dtype=np.uint8)
+    thickness = max(2, min(h, w) // 60)
+    for _ in range(4):
+        grey = rng.randint(0, 200)
+        points = [(rng.randrange(w), rng.randrange(h)) for _ in range(2)]
+        cv2.line(scribbles, points[0], points[1], grey, thickness)
+        cv2.line(mask, points[0], points[1], 255, thickness)
+    return scribbles, mask
+
+
+def solve(image, scribbles, mask, ignore_mask, beta, iterations, omega):
+    for _, result in test_diffusion(image, scribbles, mask, ignore_mask, beta, iterations, 25, None, omega):
+        depth_map = result
+    return depth_map
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--image', default=None, help='image file, defaults to the first sample image')
+    parser.add_argument('--iterations', type=int, default=300)
+    parser.add_argument('--beta', type=float, default=0.1)
+    parser.add_argument('--scale', type=float, default=1.0, help='resize factor applied to the image')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    path = args.image or os.path.join(IMAGES_DIR, sorted(os.listdir(IMAGES_DIR))[0])
+    image = cv2.imread(path)
+    if args.scale != 1.0:
+        image = cv2.resize(image, None, fx=args.scale, fy=args.scale, interpolation=cv2.INTER_AREA)
+    scribbles, mask = random_scribbles(image.shape[:2], random.Random(args.seed))
+    ignore_mask = np.zeros_like(mask)
+
+    # compile both variants before timing
+    solve(image, scribbles, mask, ignore_mask, args.beta, 1, None)
+    solve(image, scribbles, mask, ignore_mask, args.beta, 1, omega_field(image, args.beta))
+
+    timings = {}
+    for name, precompute in [('per iteration', False), ('omega field', True)]:
+        best = float('inf')
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            omega = omega_field(image, args.beta) if precompute else None
+            depth_map = solve(image, scribbles, mask, ignore_mask, args.beta, args.iterations, omega)
+            best = min(best, time.perf_counter() - start)
+        timings[name] = (best, depth_map)
+
+    h, w = image.shape[:2]
+    print(f"{os.path.basename(path)} {w}x{h}, {args.iterations} iterations, best of {args.repeat}")
+    for name, (seconds, _) in timings.items():
+        print(f"{name:<16}{seconds:>8.2f} s")
+    difference = np.abs(timings['per iteration'][1] - timings['omega field'][1]).max()
+    print(f"speedup {timings['per iteration'][0] / timings['omega field'][0]:.1f}x, max depth difference {difference:.2g}")
+
+
+if __name__ == '__main__':
+    main()
@@ -12,6 +12,19 @@ class Config:
     # Environment
     ENV = os.getenv('FLASK_ENV', 'development')
     
+    # Server mode: 'wsgi' (waitress in production) or 'asgi' (uvicorn, async SSE)
+    SERVER_MODE = os.getenv('SERVER_MODE', 'wsgi')
+    # Size of the pool running CPU work in asgi mode, defaults to the core count
+    COMPUTE_WORKERS = int(os.getenv('COMPUTE_WORKERS', os.cpu_count() or 1))
+    # Threads serving the plain Flask routes in asgi mode, kept apart from the compute pool
+    # so uploads and health checks do not queue behind diffusion steps
+    REQUEST_WORKERS = int(os.getenv('REQUEST_WORKERS', 4))
+    
+    # Largest accepted request body in bytes, larger uploads are rejected with a 413
+    MAX_CONTENT_LENGTH = int(os.getenv('MAX_CONTENT_LENGTH', 64 * 1024 * 1024))
+    # Largest decoded mask in pixels, a few bytes of RLE can describe a huge mask
+    MAX_IMAGE_PIXELS = int(os.getenv('MAX_IMAGE_PIXELS', 40_000_000))
+    
     @property
     def FRONTEND_URL(self):
         if self.ENV == 'development':
@@ -0,0 +1,99 @@
+import numpy as np
+from numba import jit
+
+
+# nogil and cache like test_diffusion, the kernels run on the compute thread pool of the
+# asgi server and must not hold the GIL over the event loop
+@jit(nopython=True, nogil=True, cache=True)
+def domain_derivatives(rgb_img, ignore_mask, sigma_s, sigma_r):
+    """
+    Derivatives of the domain transform (Gastal and Oliveira) along x and y, ignored
+    regions are treated as flat so the depth crosses them isotropically
+    """
+    h, w = rgb_img.shape[:2]
+    dx = np.ones((h, w))
+    dy = np.ones((h, w))
+    ratio = sigma_s / (sigma_r * 255)
+
+    for y in range(0, h):
+        for x in range(0, w):
+            if ignore_mask[y, x] == 255:
+                continue
+            # dx[y, x] is the step from (y, x-1) to (y, x), dy[y, x] from (y-1, x) to (y, x)
+            if x > 0 and ignore_mask[y, x-1] != 255:
+                diff = 0.0
+                for c in range(3):
+                    diff += abs(float(rgb_img[y, x, c]) - float(rgb_img[y, x-1, c]))
+                dx[y, x] = 1 + ratio * diff
+            if y > 0 and ignore_mask[y-1, x] != 255:
+                diff = 0.0
+                for c in range(3):
+                    diff += abs(float(rgb_img[y, x, c]) - float(rgb_img[y-1, x, c]))
+                dy[y, x] = 1 + ratio * diff
+
+    return dx, dy
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def recursive_filter(img, weights_x, weights_y):
+    """
+    One horizontal and one vertical pass of the recursive edge-aware filter, in place.
+    Every step is a convex combination, so the output stays within the input range
+    """
+    h, w = img.shape
+
+    for y in range(0, h):
+        for x in range(1, w):
+            img[y, x] += weights_x[y, x] * (img[y, x-1] - img[y, x])
+        for x in range(w-2, -1, -1):
+            img[y, x] += weights_x[y, x+1] * (img[y, x+1] - img[y, x])
+
+    for x in range(0, w):
+        for y in range(1, h):
+            img[y, x] += weights_y[y, x] * (img[y-1, x] - img[y, x])
+        for y in range(h-2, -1, -1):
+            img[y, x] += weights_y[y+1, x] * (img[y+1, x] - img[y, x])
+
+
+def test_domain_transform(rgb_img, scribbles, mask, ignore_mask, sigma_s=None, sigma_r=0.1, passes=3):
+    """
+    Spread the scribbles with a normalized convolution under the domain transform
+    recursive filter, each pass is O(N) whatever the distance the depth must travel
+    """
+    h, w = scribbles.shape
+    if ignore_mask is None:
+        ignore_mask = np.zeros((h, w), dtype=np.uint8)
+    if sigma_s is None:
+        sigma_s = max(h, w)
+
+    scribbled = mask == 255
+    confidence = scribbled.astype(np.float64)
+    weighted = np.where(scribbled, scribbles, 0).astype(np.float64)
+
+    dx, dy = domain_derivatives(rgb_img, ignore_mask, sigma_s, sigma_r)
+
+    for i in range(passes):
+        progress = int((i / passes) * 100)
+        yield (progress, None)
+
+        # the kernel shrinks every pass so the passes add up to a filter of deviation sigma_s
+        sigma_h = sigma_s * np.sqrt(3) * 2 ** (passes - i - 1) / np.sqrt(4 ** passes - 1)
+        a = np.exp(-np.sqrt(2) / sigma_h)
+        weights_x = a ** dx
+        weights_y = a ** dy
+
+        recursive_filter(weighted, weights_x, weights_y)
+        recursive_filter(confidence, weights_x, weights_y)
+
+    # pixels the filter never reaches (walled off by strong edges) stay white, like the
+    # initial value of the diffusion
+    reached = confidence > 0
+    depth_map = np.full((h, w), 255.0)
+    depth_map[reached] = weighted[reached] / confidence[reached]
+    if scribbled.any():
+        # only guards against rounding, the ratio is already a convex combination
+        low, high = scribbles[scribbled].min(), scribbles[scribbled].max()
+        depth_map[reached] = np.clip(depth_map[reached], low, high)
+    depth_map[scribbled] = scribbles[scribbled]
+
+    yield (100, depth_map)
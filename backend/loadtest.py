@@ -0,0 +1,376 @@
+"""
+Load test for the Flask API, replays upload -> annotate -> diffuse -> refocus sessions
+with the sample images in frontend/public/images
+
+    python loadtest.py --concurrency 8 --sessions 32
+    python loadtest.py --url http://127.0.0.1:5000 --pid <server pid>
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+IMAGES_DIR = os.path.join(BACKEND_DIR, '..', 'frontend', 'public', 'images')
+
+ENDPOINTS = ['/api/upload-image', '/api/save-annotations', '/api/process-anisotropic', '/api/process-focus']
+# These answer 200 as soon as they start streaming, their last message says whether they succeeded
+SSE_ENDPOINTS = {'/api/process-anisotropic'}
+
+
+def encode_png(image):
+    return cv2.imencode('.png', image)[1].tobytes()
+
+
+def to_data_url(image):
+    return f"data:image/png;base64,{base64.b64encode(encode_png(image)).decode('utf-8')}"
+
+
+def draw_scribbles(image, rng):
+    """
+    Draw a few grey depth strokes and one green ignore stroke on a white canvas,
+    like the annotation canvas of the frontend
+    """
+    h, w = image.shape[:2]
+    canvas = np.full((h, w, 3), 255, dtype=np.uint8)
+    thickness = max(2, min(h, w) // 60)
+
+    for _ in range(rng.randint(3, 6)):
+        grey = rng.randint(0, 200)
+        points = [(rng.randrange(w), rng.randrange(h)) for _ in range(2)]
+        cv2.line(canvas, points[0], points[1], (grey, grey, grey), thickness)
+
+    points = [(rng.randrange(w), rng.randrange(h)) for _ in range(2)]
+    cv2.line(canvas, points[0], points[1], (0, 255, 0), thickness)
+    return canvas
+
+
+def rss_bytes(pid):
+    """Resident set size of a process, from /proc on Linux"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class InProcessClient:
+    """Send requests to the app through the Flask test client, uploads are saved to upload_folder"""
+
+    def __init__(self, upload_folder):
+        from api import app as api
+        api.UPLOAD_FOLDER = upload_folder
+        self.client = api.app.test_client()
+
+    def post_json(self, path, body):
+        response = self.client.post(path, json=body)
+        return response.status_code, response.get_data(as_text=True)
+
+    def post_file(self, path, field, filename, data):
+        from io import BytesIO
+        response = self.client.post(path, data={field: (BytesIO(data), filename)},
+                                    content_type='multipart/form-data')
+        return response.status_code, response.get_data(as_text=True)
+
+
+class HttpClient:
+    """Send requests to a running server"""
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def send(self, path, body, content_type):
+        request = urllib.request.Request(self.url + path, data=body, method='POST',
+                                         headers={'Content-Type': content_type})
+        try:
+            with urllib.request.urlopen(request, timeout=600) as response:
+                return response.status, response.read().decode('utf-8')
+        except urllib.error.HTTPError as e:
+            return e.code, e.read().decode('utf-8')
+
+    def post_json(self, path, body):
+        return self.send(path, json.dumps(body).encode('utf-8'), 'application/json')
+
+    def post_file(self, path, field, filename, data):
+        boundary = uuid.uuid4().hex
+        body = (f'--{boundary}\r\n'
+                f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+                f'Content-Type: image/png\r\n\r\n').encode('utf-8') + data + f'\r\n--{boundary}--\r\n'.encode('utf-8')
+        return self.send(path, body, f'multipart/form-data; boundary={boundary}')
+
+
+def last_event(text):
+    """Get the last SSE message of a process-anisotropic response"""
+    events = [e for e in text.split('\n\n') if e.startswith('data: ')]
+    return json.loads(events[-1][len('data: '):]) if events else {}
+
+
+class MemoryWindow:
+    """Memory in use when a request started and the highest value sampled until it ended"""
+
+    def __init__(self, start):
+        self.start = start
+        self.peak = start
+
+
+class MemorySampler(threading.Thread):
+    """
+    Call read (returning bytes in use, or None) every interval seconds, every open
+    window keeps the peak sampled while it is open
+    """
+
+    def __init__(self, read, interval):
+        super().__init__(daemon=True)
+        self.read = read
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.windows = set()
+        self.stopped = threading.Event()
+
+    def sample(self):
+        used = self.read()
+        if used is not None:
+            with self.lock:
+                for window in self.windows:
+                    window.peak = max(window.peak, used)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def open(self):
+        used = self.read()
+        if used is None:
+            return None
+        window = MemoryWindow(used)
+        with self.lock:
+            self.windows.add(window)
+        return window
+
+    def close(self, window):
+        self.sample()
+        with self.lock:
+            self.windows.discard(window)
+        return window
+
+    def stop(self):
+        self.stopped.set()
+
+
+def busy_time(intervals):
+    """Seconds during which at least one of the (start, end) intervals is open"""
+    total, until = 0.0, float('-inf')
+    for start, end in sorted(intervals):
+        if end > until:
+            total += end - max(start, until)
+            until = end
+    return total
+
+
+class Stats:
+    def __init__(self, read_memory=None, sample_interval=0.01):
+        self.lock = threading.Lock()
+        # (start, end) of every request
+        self.intervals = {path: [] for path in ENDPOINTS}
+        self.errors = {path: 0 for path in ENDPOINTS}
+        # per request peak memory and its growth over the memory in use when the request started
+        self.peak_memory = {path: [] for path in ENDPOINTS}
+        self.memory_growth = {path: [] for path in ENDPOINTS}
+        self.memory = MemorySampler(read_memory, sample_interval) if read_memory else None
+        if self.memory is not None:
+            self.memory.start()
+
+    def open_window(self):
+        return self.memory.open() if self.memory is not None else None
+
+    def record(self, path, start, end, ok, window=None):
+        if window is not None:
+            self.memory.close(window)
+        with self.lock:
+            self.intervals[path].append((start, end))
+            if window is not None:
+                self.peak_memory[path].append(window.peak)
+                self.memory_growth[path].append(window.peak - window.start)
+            if not ok:
+                self.errors[path] += 1
+
+    def close(self):
+        if self.memory is not None:
+            self.memory.stop()
+
+    def report(self):
+        print(f"\n{'endpoint':<28}{'count':>7}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}"
+              f"{'p99 ms':>10}{'req/s':>8}{'peak MB':>9}{'+MB p50':>9}{'+MB max':>9}")
+        for path in ENDPOINTS:
+            if not self.intervals[path]:
+                continue
+            latencies = np.array([end - start for start, end in self.intervals[path]]) * 1000
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+            # throughput while the endpoint was being served, not over the whole run
+            throughput = len(latencies) / busy_time(self.intervals[path])
+            line = (f"{path:<28}{len(latencies):>7}{self.errors[path]:>8}{p50:>10.0f}{p95:>10.0f}"
+                    f"{p99:>10.0f}{throughput:>8.2f}")
+            if self.peak_memory[path]:
+                growth = np.array(self.memory_growth[path]) / 2**20
+                line += (f"{max(self.peak_memory[path]) / 2**20:>9.1f}{np.percentile(growth, 50):>9.1f}"
+                         f"{growth.max():>9.1f}")
+            print(line)
+
+
+def succeeded(path, status, text):
+    if status != 200:
+        return False
+    if path in SSE_ENDPOINTS:
+        return last_event(text).get('status') == 'success'
+    return True
+
+
+def timed(stats, path, call):
+    """Send a request, record it and return the response text, None if it failed"""
+    window = stats.open_window()
+    start = time.perf_counter()
+    try:
+        status, text = call()
+    except Exception as e:
+        print(f"Error calling {path}: {str(e)}")
+        stats.record(path, start, time.perf_counter(), False, window)
+        return None
+    ok = succeeded(path, status, text)
+    stats.record(path, start, time.perf_counter(), ok, window)
+    return text if ok else None
+
+
+def run_session(client, stats, image_name, image, args, seed):
+    """Replay one user session: upload, annotate, diffuse and refocus a few times"""
+    rng = random.Random(seed)
+    image_url = to_data_url(image)
+
+    timed(stats, '/api/upload-image', lambda: client.post_file(
+        '/api/upload-image', 'image', image_name, encode_png(image)))
+
+    annotations_url = to_data_url(draw_scribbles(image, rng))
+    text = timed(stats, '/api/save-annotations', lambda: client.post_json('/api/save-annotations', {
+        'imageData': image_url,
+        'annotations': annotations_url,
+        'ignoreAnnotations': annotations_url
+    }))
+    if text is None:
+        return
+    images = json.loads(text)['images']
+
+    text = timed(stats, '/api/process-anisotropic', lambda: client.post_json('/api/process-anisotropic', {
+        'imageData': image_url,
+        'annotations': images['annotations']['src'],
+        'mask': images['mask']['src'],
+        'ignoreMask': images['ignoreMask']['src'],
+        'beta': 0.1,
+        'iterations': args.iterations,
+        'method': args.method
+    }))
+    if text is None:
+        return
+    depth_url = last_event(text)['images']['anisotropic']['src']
+
+    for _ in range(args.focus_clicks):
+        timed(stats, '/api/process-focus', lambda: client.post_json('/api/process-focus', {
+            'imageData': image_url,
+            'anisotropicResult': depth_url,
+            'focusPoint': {'x': rng.random(), 'y': rng.random()}
+        }))
+
+
+def load_images(scale):
+    images = []
+    for filename in sorted(os.listdir(IMAGES_DIR)):
+        image = cv2.imread(os.path.join(IMAGES_DIR, filename))
+        if image is None:
+            continue
+        if scale != 1:
+            image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        images.append((filename, image))
+    return images
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='server to test, the app is run in-process when omitted')
+    parser.add_argument('--pid', type=int, help='pid of the server, to sample its memory')
+    parser.add_argument('--concurrency', type=int, default=4, help='number of simultaneous users')
+    parser.add_argument('--sessions', type=int, default=8, help='total number of sessions to replay')
+    parser.add_argument('--focus-clicks', type=int, default=3, help='refocus requests per session')
+    parser.add_argument('--iterations', type=int, default=300, help='diffusion iterations per session')
+    parser.add_argument('--method', default='anisotropic', help="propagation method, 'anisotropic' or 'domain_transform'")
+    parser.add_argument('--scale', type=float, default=0.5, help='resize factor for the sample images')
+    parser.add_argument('--warmup', type=int, default=1,
+                        help='untimed sessions run first, so JIT compilation is not measured')
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help='in-process only, measure traced Python and NumPy allocations instead of RSS')
+    parser.add_argument('--sample-interval', type=float, default=0.01,
+                        help='seconds between memory samples taken while requests run')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    images = load_images(args.scale)
+    if args.tracemalloc:
+        if args.url:
+            parser.error('--tracemalloc needs the in-process app')
+        tracemalloc.start()
+        read_memory = lambda: tracemalloc.get_traced_memory()[0]
+        measured = 'traced allocations'
+    else:
+        pid = args.pid or (None if args.url else os.getpid())
+        read_memory = (lambda: rss_bytes(pid)) if pid else None
+        measured = f'RSS of pid {pid}' if pid else 'nothing, pass --pid to sample the server'
+    stats = Stats(read_memory, args.sample_interval)
+    local = threading.local()
+    # in-process uploads go to a scratch folder rather than backend/uploads
+    upload_folder = None if args.url else tempfile.mkdtemp(prefix='loadtest-uploads-')
+
+    def new_client():
+        return HttpClient(args.url) if args.url else InProcessClient(upload_folder)
+
+    def session(i):
+        # one client per worker thread
+        if not hasattr(local, 'client'):
+            local.client = new_client()
+        image_name, image = images[i % len(images)]
+        run_session(local.client, stats, image_name, image, args, args.seed + i)
+
+    client = new_client()
+    for i in range(args.warmup):
+        image_name, image = images[i % len(images)]
+        run_session(client, Stats(), image_name, image, args, -1 - i)
+
+    print(f"Replaying {args.sessions} sessions with {args.concurrency} concurrent users "
+          f"against {args.url or 'the in-process app'}")
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(session, range(args.sessions)))
+    wall_time = time.perf_counter() - start
+    stats.close()
+    if upload_folder is not None:
+        shutil.rmtree(upload_folder, ignore_errors=True)
+
+    print(f"Finished in {wall_time:.1f}s, {args.sessions / wall_time:.2f} sessions/s")
+    print("req/s is counted over the time at least one request of the endpoint was running")
+    print(f"Memory: {measured}, +MB is the growth over the value when each request started")
+    stats.report()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,114 @@
+import numpy as np
 from numba import jit
 
 
-@jit(nopython=True)
-def compute_poisson(depth_map, pixel_pt):
+# Depth used for neighbours outside the image when averaging ignored pixels. The
+# ignored regions have always used 1 here, unlike the 255 of the anisotropic sweep
+OUT_OF_BOUNDS_DEPTH = 1
+
+# poisson_solve stops once the root mean square residual is below this, in grey levels
+POISSON_TOLERANCE = 1e-3
+
+
+@jit(nopython=True, cache=True)
+def poisson_stencil(ignore_mask, mask):
+    """
+    Precompute the ignored pixels and the coordinates of their 4 neighbours,
+    neighbours out of bounds are marked with -1. inner gives the position of the
+    neighbours that are ignored pixels too, -1 for the others. Annotated pixels keep
+    their scribble value, so they are left out even when ignored
+    """
+    h, w = ignore_mask.shape
+    ys, xs = np.nonzero((ignore_mask == 255) & (mask != 255))
+    index = np.full((h, w), -1, dtype=np.int64)
+    for i in range(len(ys)):
+        index[ys[i], xs[i]] = i
+
+    # neighbours in the order top, bottom, left, right
+    n_ys = np.full((len(ys), 4), -1, dtype=np.int64)
+    n_xs = np.full((len(ys), 4), -1, dtype=np.int64)
+    inner = np.full((len(ys), 4), -1, dtype=np.int64)
+    for i in range(len(ys)):
+        y, x = ys[i], xs[i]
+        if y > 0:
+            n_ys[i, 0], n_xs[i, 0] = y-1, x
+        if y < h-1:
+            n_ys[i, 1], n_xs[i, 1] = y+1, x
+        if x > 0:
+            n_ys[i, 2], n_xs[i, 2] = y, x-1
+        if x < w-1:
+            n_ys[i, 3], n_xs[i, 3] = y, x+1
+        for k in range(4):
+            if n_ys[i, k] >= 0:
+                inner[i, k] = index[n_ys[i, k], n_xs[i, k]]
+
+    return ys, xs, n_ys, n_xs, inner
+
+
+@jit(nopython=True, cache=True)
+def laplacian(values, inner, out):
+    """out = A values, with A the 4-neighbour Laplacian restricted to the ignored pixels"""
+    for i in range(len(values)):
+        total = 4 * values[i]
+        for k in range(4):
+            if inner[i, k] >= 0:
+                total -= values[inner[i, k]]
+        out[i] = total
+
+
+@jit(nopython=True, cache=True)
+def dot(a, b):
+    total = 0.0
+    for i in range(len(a)):
+        total += a[i] * b[i]
+    return total
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def poisson_solve(depth_map, stencil, max_iterations, tolerance=POISSON_TOLERANCE):
     """
-    Solve Poisson's equation using the average of the pixel's 4 neighbours
+    Solve Laplace's equation over the ignored pixels in place, with the depth of the
+    surrounding pixels as boundary condition, by conjugate gradients warm started from
+    the current depth. Returns the number of iterations used
     """
-    h, w = depth_map.shape
-    y, x = pixel_pt
+    ys, xs, n_ys, n_xs, inner = stencil
+    n = len(ys)
+    if n == 0:
+        return 0
+
+    # the known neighbours move to the right hand side
+    rhs = np.zeros(n)
+    values = np.empty(n)
+    for i in range(n):
+        values[i] = depth_map[ys[i], xs[i]]
+        for k in range(4):
+            if n_ys[i, k] < 0:
+                rhs[i] += OUT_OF_BOUNDS_DEPTH
+            elif inner[i, k] < 0:
+                rhs[i] += depth_map[n_ys[i, k], n_xs[i, k]]
 
-    # get neighbouring values, consider out of bounds as white
-    top = depth_map[y-1, x] if y > 0 else 1
-    bottom = depth_map[y+1, x] if y < h-1 else 1
-    left = depth_map[y, x-1] if x > 0 else 1
-    right = depth_map[y, x+1] if x < w-1 else 1
+    residual = np.empty(n)
+    laplacian(values, inner, residual)
+    for i in range(n):
+        residual[i] = rhs[i] - residual[i]
+    direction = residual.copy()
+    product = np.empty(n)
+    residual_norm = dot(residual, residual)
 
-    # get the avg from 4 neighbors
-    curr_depth_val = (1/4) * \
-        ((top + bottom + left + right))
+    iteration = 0
+    while iteration < max_iterations and residual_norm > tolerance * tolerance * n:
+        laplacian(direction, inner, product)
+        alpha = residual_norm / dot(direction, product)
+        for i in range(n):
+            values[i] += alpha * direction[i]
+            residual[i] -= alpha * product[i]
+        new_norm = dot(residual, residual)
+        beta = new_norm / residual_norm
+        for i in range(n):
+            direction[i] = residual[i] + beta * direction[i]
+        residual_norm = new_norm
+        iteration += 1
 
-    # This value will be used in anisotropic for ignored regions
-    return (curr_depth_val)
+    for i in range(n):
+        depth_map[ys[i], xs[i]] = values[i]
+    return iteration
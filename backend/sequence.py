@@ -0,0 +1,282 @@
+import multiprocessing
+import signal
+import threading
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from anisotropic import test_diffusion, omega_field
+from shared import SharedArrayRegistry
+
+# Worker processes are shared by all sequence requests, see get_pool
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def warm_up():
+    """
+    Compile the solver for the argument types used by the sequence workers, run once
+    in every new worker process. With the numba cache on disk this is only a load
+    """
+    frame = np.zeros((2, 2, 3), dtype=np.uint8)
+    masks = np.zeros((2, 2), dtype=np.uint8)
+    omega = omega_field(frame, 0.1)
+    for init_depth in (None, np.zeros((2, 2))):
+        for _ in test_diffusion(frame, masks, masks, masks, 0.1, 1, 1, init_depth, omega):
+            pass
+
+
+def init_worker():
+    """Set up a new worker process, Ctrl-C is left to the server, which stops the pool"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    warm_up()
+
+
+def get_pool(workers=None):
+    """
+    The worker pool of the sequence solver. It is created on first use and lives as
+    long as the server, so workers import and compile the solver only once.
+    workers sets its size when it is created
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn rather than fork, the web server process is multi-threaded
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                        initializer=init_worker)
+        return _pool
+
+
+def shutdown_pool():
+    """Stop the worker pool, the next sequence request starts a new one"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+def frame_difference(frame, prev_frame):
+    """
+    Mean absolute difference between two frames, in grey levels
+    """
+    return np.mean(np.abs(frame.astype(np.int16) - prev_frame.astype(np.int16)))
+
+
+def split_segments(n_frames, keyframes):
+    """
+    Split the frame indices into segments of (frames in solve order, keyframe, after).
+    Every keyframe starts a segment running forward to the next keyframe. Frames before
+    the first keyframe are solved backwards from it, in a segment warm started from the
+    depth of frame after once that frame is solved
+    """
+    keys = sorted(keyframes)
+    ends = keys[1:] + [n_frames]
+    segments = [(list(range(key, end)), key, None) for key, end in zip(keys, ends)]
+    if keys[0] > 0:
+        segments.append((list(range(keys[0] - 1, -1, -1)), keys[0], keys[0]))
+    return segments
+
+
+def solve_frame_shared(frame_handle, keyframe_handles, init_handle, depth_handle, omega_handle, update_omega,
+                       beta, iterations, poisson_interval):
+    """
+    Solve one frame on frames and scribbles in shared memory, writing the depth map in
+    place, so no image data is pickled between processes. The solve is warm started
+    from init_handle when set, and the omega field is first recomputed if update_omega
+    """
+    registry = SharedArrayRegistry()
+    try:
+        _solve_frame_into(registry, frame_handle, keyframe_handles, init_handle, depth_handle, omega_handle,
+                          update_omega, beta, iterations, poisson_interval)
+    finally:
+        registry.close()
+
+
+def _solve_frame_into(registry, frame_handle, keyframe_handles, init_handle, depth_handle, omega_handle,
+                      update_omega, beta, iterations, poisson_interval):
+    # the shared arrays only live in this scope, so the registry can unmap them after
+    frame = registry.array(frame_handle)
+    scribbles, mask, ignore_mask = (registry.array(handle) if handle is not None else None
+                                    for handle in keyframe_handles)
+    init_depth = registry.array(init_handle) if init_handle is not None else None
+    omega = registry.array(omega_handle)
+    if update_omega:
+        omega[...] = omega_field(frame, beta)
+
+    for _, result in test_diffusion(frame, scribbles, mask, ignore_mask, beta, iterations, poisson_interval,
+                                    init_depth, omega):
+        if result is not None:
+            registry.array(depth_handle)[...] = result
+
+
+class Segment:
+    """
+    Frames of one segment, solved in order, each one warm started from the depth of the
+    previous frame, the first one from frame after (cold if None). The segment's omega
+    field is reused while frames differ by less than similarity from the frame it was
+    computed on
+    """
+
+    def __init__(self, frames, keyframe, after=None):
+        self.frames = frames
+        self.position = 0
+        self.keyframe = keyframe
+        self.after = after
+        self.omega_handle = None
+        self.omega_frame = None
+
+    def next_frame(self):
+        """The next frame to solve and the frame it is warm started from"""
+        i = self.frames[self.position]
+        init = self.frames[self.position - 1] if self.position > 0 else self.after
+        self.position += 1
+        return i, init
+
+    def finished(self):
+        return self.position == len(self.frames)
+
+    def needs_omega(self, registry, frame_handle, similarity):
+        """Whether the omega field must be recomputed for this frame"""
+        if self.omega_handle is None:
+            # only allocated while the segment is being solved, 16 bytes per pixel
+            h, w = frame_handle.shape[:2]
+            self.omega_handle = registry.create((h, w, 4), np.float32)
+        else:
+            difference = frame_difference(registry.array(frame_handle), registry.array(self.omega_frame))
+            if difference <= similarity:
+                return False
+        self.omega_frame = frame_handle
+        return True
+
+
+class SequenceSolve:
+    """
+    Schedules the frames of a sequence on the worker pool, one task per frame. start
+    submits the first frame of every segment and frame_done the frames waiting on a
+    finished one, so a caller only has to wait on futures, from a thread as in
+    test_sequence or from an event loop.
+    Frames and scribbles can be arrays or SharedArray handles from registry, arrays are
+    copied into shared memory once and workers read them and write results in place
+    """
+
+    def __init__(self, frames, keyframes, registry, beta=0.1, iterations=3000, warm_iterations=500,
+                 poisson_interval=25, similarity=2.0, workers=None):
+        if not frames:
+            raise ValueError("At least one frame is required")
+        if not keyframes:
+            raise ValueError("At least one keyframe with scribbles is required")
+        if any(k < 0 or k >= len(frames) for k in keyframes):
+            raise ValueError("Keyframe index out of range")
+        # the solver does not bounds check, every image must match the frame size
+        h, w = frames[0].shape[:2]
+        if any(frame.shape[:2] != (h, w) for frame in frames):
+            raise ValueError("All frames must have the same size")
+        if any(img is not None and img.shape[:2] != (h, w) for images in keyframes.values() for img in images):
+            raise ValueError(f"Keyframe scribbles and masks must be {w}x{h}")
+
+        self.registry = registry
+        self.beta = beta
+        self.iterations = iterations
+        self.warm_iterations = warm_iterations
+        self.poisson_interval = poisson_interval
+        self.similarity = similarity
+        self.workers = workers
+
+        self.frame_handles = [registry.share(frame) for frame in frames]
+        self.keyframe_handles = {k: tuple(registry.share(img) if img is not None else None for img in images)
+                                 for k, images in keyframes.items()}
+        self.depth_handles = [registry.create((h, w)) for _ in frames]
+        self.segments = [Segment(*segment) for segment in split_segments(len(frames), keyframes)]
+        # segments warm started from another segment's frame wait for that frame
+        self.waiting = {}
+        # future of every frame being solved, with its segment and index
+        self.futures = {}
+        self.done = 0
+
+    def start(self):
+        for segment in self.segments:
+            if segment.after is None:
+                self.submit(segment)
+            else:
+                self.waiting.setdefault(segment.after, []).append(segment)
+
+    def submit(self, segment):
+        i, init = segment.next_frame()
+        update_omega = segment.needs_omega(self.registry, self.frame_handles[i], self.similarity)
+        try:
+            future = get_pool(self.workers).submit(
+                solve_frame_shared, self.frame_handles[i], self.keyframe_handles[segment.keyframe],
+                self.depth_handles[init] if init is not None else None, self.depth_handles[i],
+                segment.omega_handle, update_omega, self.beta,
+                self.iterations if init is None else self.warm_iterations, self.poisson_interval)
+        except BrokenProcessPool:
+            shutdown_pool()
+            raise
+        self.futures[future] = (segment, i)
+
+    def frame_done(self, future):
+        """Collect a finished frame, submit the frames it unblocks and return the progress in percent"""
+        segment, i = self.futures.pop(future)
+        try:
+            future.result()
+        except BrokenProcessPool:
+            # a worker died (e.g. killed for memory), the next request starts a fresh pool
+            shutdown_pool()
+            raise
+        self.done += 1
+        for dependent in self.waiting.pop(i, []):
+            self.submit(dependent)
+        if segment.finished():
+            self.registry.release(segment.omega_handle)
+        else:
+            self.submit(segment)
+        return int(self.done / len(self.frame_handles) * 100)
+
+    def result(self):
+        """Copies of the depth maps, the shared blocks are released when the solve ends"""
+        return [self.registry.array(handle).copy() for handle in self.depth_handles]
+
+    def cancel(self):
+        """Drop the frames still queued, a frame being solved keeps its blocks mapped
+        until it ends even once the registry unlinks them"""
+        for future in self.futures:
+            future.cancel()
+
+
+def test_sequence(frames, keyframes, beta=0.1, iterations=3000, warm_iterations=500, poisson_interval=25,
+                  similarity=2.0, workers=None, stream_progress=False, registry=None):
+    """
+    Propagate scribble depth over a sequence of frames
+
+    keyframes maps a frame index to its (scribbles, mask, ignore_mask), every frame uses
+    the scribbles of the closest keyframe before it, frames before the first keyframe
+    use the first one. The segments between keyframes are independent and are solved
+    in parallel on the shared worker pool, one task per frame, so progress is reported
+    as every frame finishes. See SequenceSolve for the frames and scribbles accepted
+    """
+    own_registry = registry is None
+    if own_registry:
+        registry = SharedArrayRegistry()
+
+    solve = None
+    try:
+        solve = SequenceSolve(frames, keyframes, registry, beta, iterations, warm_iterations, poisson_interval,
+                              similarity, workers)
+        solve.start()
+        while solve.futures:
+            finished, _ = wait(solve.futures, return_when=FIRST_COMPLETED)
+            for future in finished:
+                progress = solve.frame_done(future)
+                if stream_progress and progress < 100:
+                    yield progress, None
+
+        yield 100, solve.result()
+
+    except Exception as e:
+        print(f"Error in test_sequence: {str(e)}")
+        raise e
+    finally:
+        if solve is not None:
+            solve.cancel()
+        if own_registry:
+            registry.close()
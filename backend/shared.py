@@ -0,0 +1,82 @@
+import numpy as np
+from multiprocessing import shared_memory
+
+
+class SharedArray:
+    """
+    Picklable handle to a NumPy array in shared memory, only the block name, shape
+    and dtype are sent to other processes
+    """
+
+    def __init__(self, name, shape, dtype):
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype).str
+
+    def __repr__(self):
+        return f"SharedArray({self.name!r}, {self.shape}, {self.dtype!r})"
+
+
+class SharedArrayRegistry:
+    """
+    Keeps track of the shared memory blocks used by one process. Blocks created here
+    are unlinked on close, blocks attached from a handle are only unmapped.
+    Arrays obtained from the registry must be released before it is closed
+    """
+
+    def __init__(self):
+        self.blocks = {}
+        self.owned = set()
+
+    def create(self, shape, dtype=np.float64):
+        """Allocate a shared array and return its handle"""
+        size = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+        block = shared_memory.SharedMemory(create=True, size=size)
+        self.blocks[block.name] = block
+        self.owned.add(block.name)
+        return SharedArray(block.name, shape, dtype)
+
+    def share(self, array):
+        """Copy an array into shared memory and return its handle"""
+        if isinstance(array, SharedArray):
+            return array
+        handle = self.create(array.shape, array.dtype)
+        self.array(handle)[...] = array
+        return handle
+
+    def array(self, handle):
+        """Map the array of a handle into this process, without copying"""
+        block = self.blocks.get(handle.name)
+        if block is None:
+            block = shared_memory.SharedMemory(name=handle.name)
+            self.blocks[handle.name] = block
+        return np.ndarray(handle.shape, dtype=handle.dtype, buffer=block.buf)
+
+    def release(self, handle):
+        """Unmap the block of a handle before the registry is closed, unlinking it if owned"""
+        block = self.blocks.pop(handle.name, None)
+        if block is None:
+            return
+        block.close()
+        if handle.name in self.owned:
+            self.owned.discard(handle.name)
+            block.unlink()
+
+    def close(self):
+        for name, block in self.blocks.items():
+            try:
+                block.close()
+            except BufferError:
+                # an array still uses the block (e.g. held by a traceback), it is
+                # unmapped when that array is freed
+                pass
+            if name in self.owned:
+                block.unlink()
+        self.blocks = {}
+        self.owned = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+from domain_transform import test_domain_transform as domain_transform
+from api import app as api
+
+
+def solve(image, scribbles, mask, ignore_mask=None, **options):
+    *_, (progress, depth_map) = domain_transform(image, scribbles, mask, ignore_mask, **options)
+    assert progress == 100
+    return depth_map
+
+
+def two_strokes(h, w):
+    """Depth 50 on a column on the left, 200 on a column on the right"""
+    scribbles = np.zeros((h, w), dtype=np.uint8)
+    mask = np.zeros((h, w), dtype=np.uint8)
+    mask[:, 5] = mask[:, w - 5] = 255
+    scribbles[:, 5], scribbles[:, w - 5] = 50, 200
+    return scribbles, mask
+
+
+@pytest.mark.parametrize('passes', [1, 3, 5])
+def test_output_stays_within_the_scribble_range(passes):
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, (40, 60, 3), dtype=np.uint8)
+    scribbles, mask = two_strokes(40, 60)
+    depth_map = solve(image, scribbles, mask, passes=passes)
+    assert depth_map.min() >= 50 and depth_map.max() <= 200
+    assert (depth_map[mask == 255] == scribbles[mask == 255]).all()
+
+
+def test_edges_block_propagation():
+    image = np.zeros((40, 60, 3), dtype=np.uint8)
+    image[:, 30:] = 255
+    scribbles, mask = two_strokes(40, 60)
+
+    depth_map = solve(image, scribbles, mask)
+    assert np.allclose(depth_map[:, :30], 50, atol=1)
+    assert np.allclose(depth_map[:, 30:], 200, atol=1)
+
+    # without the edge both depths blend across the middle
+    flat = solve(np.zeros_like(image), scribbles, mask)
+    assert 80 < flat[:, 29].mean() < 170
+
+
+def test_ignored_regions_are_crossed():
+    image = np.zeros((40, 60, 3), dtype=np.uint8)
+    image[:, 30:] = 255
+    scribbles, mask = two_strokes(40, 60)
+    ignore_mask = np.zeros((40, 60), dtype=np.uint8)
+    ignore_mask[:, 20:40] = 255
+
+    depth_map = solve(image, scribbles, mask, ignore_mask)
+    assert 80 < depth_map[:, 30].mean() < 170
+
+
+def test_unknown_method_answers_400():
+    client = api.app.test_client()
+    response = client.post('/api/process-anisotropic', json={'method': 'guided'})
+    assert response.status_code == 400
+    assert "'guided'" in response.json['message']
@@ -0,0 +1,64 @@
+import numpy as np
+from anisotropic import test_diffusion as diffusion, omega_field
+from poisson import poisson_stencil, poisson_solve
+
+
+def region_residual(depth_map, ignore_mask):
+    """Largest Laplacian of the depth inside the ignored region, 0 once it is harmonic"""
+    ys, xs = np.nonzero(ignore_mask == 255)
+    padded = np.pad(depth_map, 1, constant_values=1)
+    y, x = ys + 1, xs + 1
+    laplacian = (4 * padded[y, x] - padded[y - 1, x] - padded[y + 1, x]
+                 - padded[y, x - 1] - padded[y, x + 1])
+    return np.abs(laplacian).max()
+
+
+def large_region(h=300, w=400):
+    """An ignored region covering most of the image, every other pixel scribbled"""
+    ignore_mask = np.zeros((h, w), dtype=np.uint8)
+    ignore_mask[35:265, 50:350] = 255
+    mask = np.where(ignore_mask == 255, 0, 255).astype(np.uint8)
+    scribbles = np.zeros((h, w), dtype=np.uint8)
+    scribbles[:, :w // 2] = 60
+    scribbles[:, w // 2:] = 180
+    return scribbles, mask, ignore_mask
+
+
+def test_solve_makes_a_large_region_harmonic():
+    scribbles, mask, ignore_mask = large_region()
+    depth_map = np.where(mask == 255, scribbles, 255).astype(np.float64)
+
+    iterations = poisson_solve(depth_map, poisson_stencil(ignore_mask, mask), 2000)
+    assert 0 < iterations < 2000
+    assert region_residual(depth_map, ignore_mask) < 1e-2
+    # the boundary is untouched
+    assert (depth_map[mask == 255] == scribbles[mask == 255]).all()
+
+
+def test_solve_fills_a_constant_boundary_with_the_constant():
+    ignore_mask = np.zeros((60, 80), dtype=np.uint8)
+    ignore_mask[10:50, 10:70] = 255
+    mask = np.where(ignore_mask == 255, 0, 255).astype(np.uint8)
+    depth_map = np.where(mask == 255, 120.0, 255.0)
+
+    poisson_solve(depth_map, poisson_stencil(ignore_mask, mask), 2000)
+    assert np.allclose(depth_map, 120, atol=1e-2)
+
+
+def test_diffusion_converges_on_a_large_ignored_region():
+    scribbles, mask, ignore_mask = large_region()
+    image = np.zeros(scribbles.shape + (3,), dtype=np.uint8)
+
+    # a handful of iterations is enough, the region no longer fills one sweep at a time
+    *_, (_, depth_map) = diffusion(image, scribbles, mask, ignore_mask, 0.1, 50, 25,
+                                   None, omega_field(image, 0.1))
+    assert region_residual(depth_map, ignore_mask) < 1e-2
+    # the centre sits between both sides rather than at the white start value
+    assert 100 < depth_map[150, 200] < 140
+
+
+def test_solve_leaves_images_without_ignored_pixels_alone():
+    mask = np.zeros((4, 5), dtype=np.uint8)
+    depth_map = np.full((4, 5), 7.0)
+    assert poisson_solve(depth_map, poisson_stencil(mask, mask), 100) == 0
+    assert (depth_map == 7).all()
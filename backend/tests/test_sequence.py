@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+import sequence
+from anisotropic import test_diffusion as diffusion, omega_field
+from sequence import split_segments, test_sequence as solve_sequence
+
+ITERATIONS = 60
+WARM_ITERATIONS = 20
+POISSON_INTERVAL = 10
+
+
+@pytest.fixture(scope='module', autouse=True)
+def worker_pool():
+    yield
+    sequence.shutdown_pool()
+
+
+@pytest.fixture
+def clip():
+    """Five 48x64 frames, identical or far apart, and two keyframes with scribbles"""
+    rng = np.random.default_rng(1)
+    base = rng.integers(0, 256, (48, 64, 3), dtype=np.uint8)
+    shifted = np.roll(base, 3, axis=1)
+    frames = [base, base, shifted, shifted, base]
+
+    scribbles = np.zeros((48, 64), dtype=np.uint8)
+    mask = np.zeros((48, 64), dtype=np.uint8)
+    mask[5:8, 5:50] = 255
+    scribbles[mask == 255] = 90
+    ignore_mask = np.zeros((48, 64), dtype=np.uint8)
+    ignore_mask[20:30, 20:30] = 255
+    keyframes = {2: (scribbles, mask, ignore_mask), 4: (scribbles // 2, mask, ignore_mask)}
+    return frames, keyframes
+
+
+def solve_frame(frame, images, iterations, init_depth):
+    *_, (_, depth_map) = diffusion(frame, *images, 0.1, iterations, POISSON_INTERVAL, init_depth,
+                                   omega_field(frame, 0.1))
+    return depth_map
+
+
+def test_frames_before_the_first_keyframe_are_solved_backwards():
+    assert split_segments(6, [2, 4]) == [([2, 3], 2, None), ([4, 5], 4, None), ([1, 0], 2, 2)]
+    assert split_segments(3, [0]) == [([0, 1, 2], 0, None)]
+
+
+def test_sequence_matches_a_sequential_solve(clip):
+    frames, keyframes = clip
+    *_, (progress, depth_maps) = solve_sequence(frames, keyframes, iterations=ITERATIONS,
+                                                warm_iterations=WARM_ITERATIONS,
+                                                poisson_interval=POISSON_INTERVAL, workers=2)
+    assert progress == 100
+
+    # keyframes are solved cold, every other frame warm from its neighbour towards the keyframe
+    expected = [None] * 5
+    expected[2] = solve_frame(frames[2], keyframes[2], ITERATIONS, None)
+    expected[3] = solve_frame(frames[3], keyframes[2], WARM_ITERATIONS, expected[2])
+    expected[1] = solve_frame(frames[1], keyframes[2], WARM_ITERATIONS, expected[2])
+    expected[0] = solve_frame(frames[0], keyframes[2], WARM_ITERATIONS, expected[1])
+    expected[4] = solve_frame(frames[4], keyframes[4], ITERATIONS, None)
+
+    for depth_map, reference in zip(depth_maps, expected):
+        assert np.array_equal(depth_map, reference)
+
+
+def test_sequence_streams_progress_for_every_frame(clip):
+    frames, keyframes = clip
+    events = list(solve_sequence(frames, {0: keyframes[2]}, iterations=ITERATIONS,
+                                 warm_iterations=WARM_ITERATIONS, workers=2, stream_progress=True))
+    assert [progress for progress, _ in events] == [20, 40, 60, 80, 100]
+
+
+def test_sequence_rejects_masks_of_another_size(clip):
+    frames, keyframes = clip
+    scribbles, mask, _ = keyframes[2]
+    with pytest.raises(ValueError):
+        list(solve_sequence(frames, {2: (scribbles, mask, np.zeros((4, 4), dtype=np.uint8))}))
@@ -0,0 +1,110 @@
+import asyncio
+import threading
+from multiprocessing import shared_memory
+import numpy as np
+import pytest
+from api import asgi
+from shared import SharedArrayRegistry
+
+
+def exists(handle):
+    try:
+        shared_memory.SharedMemory(name=handle.name).close()
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def test_attached_arrays_share_memory_and_only_the_owner_unlinks():
+    owner = SharedArrayRegistry()
+    handle = owner.share(np.arange(6, dtype=np.int32).reshape(2, 3))
+
+    other = SharedArrayRegistry()
+    other.array(handle)[0, 0] = 7
+    assert (other.array(handle) == [[7, 1, 2], [3, 4, 5]]).all()
+    other.close()
+    assert owner.array(handle)[0, 0] == 7
+
+    owner.close()
+    assert not exists(handle)
+
+
+def test_release_unlinks_owned_blocks_only():
+    owner = SharedArrayRegistry()
+    handle = owner.create((3,))
+
+    with SharedArrayRegistry() as other:
+        other.array(handle)
+        other.release(handle)
+        assert handle.name not in other.blocks
+    assert exists(handle)
+
+    owner.release(handle)
+    assert not exists(handle)
+    # releasing twice or closing after a release is harmless
+    owner.release(handle)
+    owner.close()
+
+
+def test_sharing_a_handle_returns_it_unchanged():
+    with SharedArrayRegistry() as registry:
+        handle = registry.create((2, 2), np.uint8)
+        assert registry.share(handle) is handle
+        assert registry.array(handle).dtype == np.uint8
+
+
+def test_stream_closes_the_registry_after_the_running_step():
+    registry = SharedArrayRegistry()
+    handle = registry.create((4,))
+    started, resume = threading.Event(), threading.Event()
+    log = []
+
+    def events():
+        try:
+            yield "data: {}\n\n"
+            started.set()
+            resume.wait(5)
+            registry.array(handle)[...] = 1
+            log.append('step')
+            yield "data: {}\n\n"
+        finally:
+            log.append('generator closed')
+
+    async def receive():
+        # the client leaves while the second step runs, which ends a moment later
+        await asyncio.get_running_loop().run_in_executor(None, started.wait, 5)
+        threading.Timer(0.2, resume.set).start()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        pass
+
+    async def handler():
+        scope = {'type': 'http', 'path': '/api/process-sequence', 'headers': []}
+        try:
+            await asgi.stream_events(scope, receive, send, asgi.iterate_in_executor(events(), asgi.compute_pool))
+        finally:
+            log.append('registry closed')
+            registry.close()
+
+    asyncio.run(handler())
+    assert log == ['step', 'generator closed', 'registry closed']
+    assert not exists(handle)
+
+
+def test_cancelled_executor_steps_finish_before_raising():
+    finished = threading.Event()
+
+    def slow():
+        threading.Event().wait(0.2)
+        finished.set()
+
+    async def main():
+        task = asyncio.create_task(asgi.finish_in_executor(asgi.compute_pool, slow))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return finished.is_set()
+
+    assert asyncio.run(main())
@@ -0,0 +1,267 @@
+import asyncio
+import io
+import json
+import cv2
+import numpy as np
+import pytest
+from werkzeug.datastructures import FileStorage
+from werkzeug.exceptions import BadRequest
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
+from api import app as api
+from api import asgi
+
+
+def png(image, *params):
+    return cv2.imencode('.png', image, *params)[1].tobytes()
+
+
+def data_url(image):
+    import base64
+    return 'data:image/png;base64,' + base64.b64encode(png(image)).decode('utf-8')
+
+
+def rle(size, counts):
+    return np.frombuffer(json.dumps({'size': size, 'counts': counts}).encode('utf-8'), dtype=np.uint8)
+
+
+@pytest.fixture
+def client():
+    return api.app.test_client()
+
+
+@pytest.fixture
+def images():
+    image = np.zeros((6, 8, 3), dtype=np.uint8)
+    image[:, 4:] = 200
+    mask = np.zeros((6, 8), dtype=np.uint8)
+    mask[2, 1:5] = 255
+    return image, mask
+
+
+# decode_rle_mask
+
+def test_rle_decodes_row_major_runs_starting_with_zero():
+    mask = api.decode_rle_mask(rle([2, 3], [1, 3, 2]))
+    assert mask.dtype == np.uint8
+    assert mask.tolist() == [[0, 255, 255], [255, 0, 0]]
+
+
+def test_rle_accepts_an_even_number_of_runs():
+    mask = api.decode_rle_mask(rle([1, 4], [0, 2, 2, 0]))
+    assert mask.tolist() == [[255, 255, 0, 0]]
+
+
+@pytest.mark.parametrize('counts', [[1, 2], [4, 4], []])
+def test_rle_rejects_counts_not_covering_the_image(counts):
+    with pytest.raises(ValueError):
+        api.decode_rle_mask(rle([2, 3], counts))
+
+
+def test_rle_rejects_negative_runs():
+    with pytest.raises(ValueError):
+        api.decode_rle_mask(rle([1, 2], [3, -1]))
+
+
+@pytest.mark.parametrize('size', [[20000, 20000], [0, 5], [-2, -3]])
+def test_rle_rejects_sizes_before_allocating(size):
+    import tracemalloc
+    tracemalloc.start()
+    try:
+        with pytest.raises(ValueError):
+            api.decode_rle_mask(rle(size, [abs(size[0] * size[1])]))
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert peak < 1024 * 1024
+
+
+def test_rle_size_limit_follows_config(monkeypatch):
+    monkeypatch.setattr(api.config, 'MAX_IMAGE_PIXELS', 6)
+    assert api.decode_rle_mask(rle([2, 3], [6])).shape == (2, 3)
+    with pytest.raises(ValueError, match='larger than 6 pixels'):
+        api.decode_rle_mask(rle([1, 7], [7]))
+
+
+def test_rle_rejects_invalid_json():
+    with pytest.raises(ValueError):
+        api.decode_rle_mask(np.frombuffer(b'{"size": [1, 2]', dtype=np.uint8))
+
+
+def test_decode_upload_reads_rle_and_bilevel_png(images):
+    _, mask = images
+    flat = (mask.ravel() > 0).astype(np.int8)
+    changes = np.flatnonzero(np.diff(np.r_[0, flat, 0]))
+    counts = np.diff(np.r_[0, changes, flat.size]).tolist()
+
+    from_rle = api.decode_upload(FileStorage(io.BytesIO(rle([6, 8], counts).tobytes()), 'mask.rle'))
+    from_png = api.decode_upload(FileStorage(io.BytesIO(png(mask, [cv2.IMWRITE_PNG_BILEVEL, 1])), 'mask.png'),
+                                 grayscale=True)
+    assert (from_rle == mask).all()
+    assert (from_png == mask).all()
+
+
+def test_decode_upload_returns_none_for_bad_rle():
+    upload = FileStorage(io.BytesIO(rle([2, 2], [1]).tobytes()), 'mask.rle')
+    assert api.decode_upload(upload) is None
+
+
+# read_request_images
+
+def request(**kwargs):
+    return Request(EnvironBuilder(method='POST', **kwargs).get_environ())
+
+
+def test_multipart_requests_decode_file_parts(images):
+    image, mask = images
+    req = request(data={'imageData': (io.BytesIO(png(image)), 'image.png'),
+                        'mask': (io.BytesIO(png(mask)), 'mask.png'),
+                        'beta': '0.2'})
+    data, decode = api.read_request_images(req)
+    assert data['beta'] == '0.2'
+    assert decode('imageData').shape == (6, 8, 3)
+    assert (decode('mask', grayscale=True) == mask).all()
+
+
+def test_json_requests_decode_base64_fields(images):
+    image, mask = images
+    req = request(json={'imageData': data_url(image), 'mask': data_url(mask), 'beta': 0.2})
+    data, decode = api.read_request_images(req)
+    assert data['beta'] == 0.2
+    assert decode('imageData').shape == (6, 8, 3)
+    assert (decode('mask', grayscale=True) == mask).all()
+
+
+def test_multipart_request_without_file_parts_names_the_missing_part():
+    req = request(data={'beta': '0.2'}, content_type='multipart/form-data')
+    _, decode = api.read_request_images(req)
+    with pytest.raises(BadRequest, match="'imageData'"):
+        decode('imageData')
+
+
+def test_json_request_missing_field_names_it(images):
+    image, _ = images
+    _, decode = api.read_request_images(request(json={'imageData': data_url(image)}))
+    with pytest.raises(BadRequest, match="'mask'"):
+        decode('mask')
+
+
+def test_unsupported_content_type_is_a_bad_request():
+    with pytest.raises(BadRequest, match='text/plain'):
+        api.read_request_images(request(data=b'hello', content_type='text/plain'))
+
+
+def test_endpoint_answers_400_for_multipart_without_files(client):
+    response = client.post('/api/process-anisotropic', data={'beta': '0.1'}, content_type='multipart/form-data')
+    assert response.status_code == 400
+    assert "'imageData'" in response.json['message']
+
+
+def test_focus_endpoint_answers_400_for_missing_focus_point(client, images):
+    image, mask = images
+    response = client.post('/api/process-focus', json={'imageData': data_url(image),
+                                                       'anisotropicResult': data_url(mask)})
+    assert response.status_code == 400
+    assert 'focusPoint' in response.json['message']
+
+
+# size limits
+
+def test_flask_rejects_bodies_over_the_limit(client, monkeypatch):
+    monkeypatch.setattr(api.config, 'MAX_CONTENT_LENGTH', 100)
+    response = client.post('/api/process-anisotropic', data=b'x' * 101, content_type='application/json')
+    assert response.status_code == 413
+
+
+def run_asgi(path, headers, chunks):
+    """Send a POST through the ASGI app and return the status and body"""
+    messages = [{'type': 'http.request', 'body': chunk, 'more_body': i < len(chunks) - 1}
+                for i, chunk in enumerate(chunks)]
+    sent = []
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await asyncio.sleep(3600)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'method': 'POST', 'path': path, 'query_string': b'',
+             'headers': [(k.encode('latin-1'), v.encode('latin-1')) for k, v in headers]}
+    asyncio.run(asgi.app(scope, receive, send))
+
+    status = next(m['status'] for m in sent if m['type'] == 'http.response.start')
+    body = b''.join(m.get('body', b'') for m in sent if m['type'] == 'http.response.body')
+    return status, body
+
+
+def test_asgi_rejects_declared_length_over_the_limit(monkeypatch):
+    monkeypatch.setattr(asgi.config, 'MAX_CONTENT_LENGTH', 100)
+    status, body = run_asgi('/api/process-focus', [('content-length', '101')], [b''])
+    assert status == 413
+
+
+def test_asgi_rejects_chunked_bodies_growing_over_the_limit(monkeypatch):
+    monkeypatch.setattr(asgi.config, 'MAX_CONTENT_LENGTH', 100)
+    status, body = run_asgi('/api/process-anisotropic', [('transfer-encoding', 'chunked')], [b'x' * 60] * 2)
+    assert status == 413
+
+
+def test_asgi_reads_chunked_multipart_without_content_length(images):
+    image, mask = images
+    builder = EnvironBuilder(method='POST', data={
+        'imageData': (io.BytesIO(png(image)), 'image.png'),
+        'anisotropicResult': (io.BytesIO(png(mask)), 'depth.png'),
+        'focusPoint': json.dumps({'x': 0.5, 'y': 0.5})
+    })
+    environ = builder.get_environ()
+    body = environ['wsgi.input'].read()
+    chunks = [body[:len(body) // 2], body[len(body) // 2:]]
+
+    status, response = run_asgi('/api/process-focus', [('content-type', environ['CONTENT_TYPE']),
+                                                       ('transfer-encoding', 'chunked')], chunks)
+    assert status == 200
+    assert json.loads(response)['status'] == 'success'
+
+
+# mask shapes
+
+def test_anisotropic_endpoint_answers_400_for_masks_of_another_size(client, images):
+    image, mask = images
+    response = client.post('/api/process-anisotropic', json={
+        'imageData': data_url(image), 'annotations': data_url(mask),
+        'mask': data_url(np.zeros((7, 8), dtype=np.uint8)), 'ignoreMask': data_url(mask)})
+    assert response.status_code == 400
+    assert 'mask is 8x7' in response.json['message']
+
+
+@pytest.mark.parametrize('size', [(4, 8), (6, 9)])
+def test_sequence_endpoint_answers_400_for_keyframe_masks_of_another_size(client, images, size):
+    image, mask = images
+    response = client.post('/api/process-sequence', json={
+        'frames': [data_url(image)] * 2,
+        'keyframes': [{'index': 0, 'annotations': data_url(mask), 'mask': data_url(mask),
+                       'ignoreMask': data_url(np.zeros(size, dtype=np.uint8))}]})
+    assert response.status_code == 400
+    assert 'keyframe 0' in response.json['message']
+
+
+def test_sequence_multipart_answers_400_for_keyframe_masks_of_another_size(client, images):
+    image, mask = images
+    response = client.post('/api/process-sequence', data={
+        'frames': [(io.BytesIO(png(image)), 'frame0.png'), (io.BytesIO(png(image)), 'frame1.png')],
+        'keyframes': '[1]',
+        'annotations.1': (io.BytesIO(png(mask[:3])), 'annotations.png'),
+        'mask.1': (io.BytesIO(png(mask)), 'mask.png'),
+        'ignoreMask.1': (io.BytesIO(png(mask)), 'ignore.png')
+    })
+    assert response.status_code == 400
+    assert 'annotations is 8x3' in response.json['message']
+
+
+def test_sequence_endpoint_answers_400_for_keyframes_out_of_range(client, images):
+    image, mask = images
+    response = client.post('/api/process-sequence', json={
+        'frames': [data_url(image)], 'keyframes': [{'index': 3, 'mask': data_url(mask)}]})
+    assert response.status_code == 400
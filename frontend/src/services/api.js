@@ -121,6 +121,7 @@ export const processAnisotropic = async (
         ignoreMask: options.ignoreMask,
         beta: options.beta,
         iterations: options.iterations,
+        method: options.method,
       }),
     });
 